@@ -0,0 +1,144 @@
+import logging
+import os
+import time
+from collections import deque
+from concurrent import futures
+
+import hydra
+import lightgbm as lgb
+import pandas as pd
+from dotenv import load_dotenv
+from minio import Minio
+from omegaconf import DictConfig
+
+from model_store import ModelStore
+from utils_predict import build_flight_df
+
+log = logging.getLogger(__name__)
+
+FEATURE_COLUMNS = ["date", "source", "destination", "start_time", "end_time"]
+
+# Model of the current worker process, loaded once by init_worker
+_model: lgb.Booster | None = None
+
+
+def init_worker(model_str: str):
+    global _model
+    _model = lgb.Booster(model_str=model_str)
+
+
+def score_chunk(chunk: pd.DataFrame, date_format: str, hour_format: str) -> pd.DataFrame:
+    df = build_flight_df(
+        chunk[FEATURE_COLUMNS].copy(), date_format=date_format, hour_format=hour_format
+    )
+    # The pool runs one process per CPU, the default of the model (num_threads=0,
+    # all the CPUs) would run num_processes^2 OpenMP threads
+    chunk["predicted_price"] = _model.predict(df[_model.feature_name()], num_threads=1)
+    return chunk
+
+
+def read_chunks(file_path: str, chunk_size: int):
+    """
+    Reads a CSV or Parquet file in chunks of chunk_size rows.
+    """
+    if file_path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file_path, sep=";", dtype=str, chunksize=chunk_size)
+
+
+class ChunkWriter:
+    """
+    Appends scored chunks to a CSV or Parquet file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.parquet_writer = None
+        self.header = True
+
+    def write(self, chunk: pd.DataFrame):
+        if self.file_path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.file_path, table.schema)
+            self.parquet_writer.write_table(table)
+        else:
+            chunk.to_csv(
+                self.file_path, sep=";", index=False, header=self.header,
+                mode="w" if self.header else "a",
+            )
+        self.header = False
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def load_model_str(cfg: DictConfig) -> str:
+    if cfg.get("model_file"):
+        log.info(f"Loading model from {cfg.model_file}")
+        return lgb.Booster(model_file=cfg.model_file).model_to_string()
+
+    load_dotenv()
+    minio_client = Minio(
+        endpoint=cfg.minio.endpoint,
+        access_key=cfg.minio.access_key,
+        secret_key=cfg.minio.secret_key,
+        secure=cfg.minio.secure_connection,
+    )
+    model_store = ModelStore(minio_client, cfg.minio.bucket_name_model)
+    model_store.load_latest_model()
+    if model_store.model is None:
+        raise Exception(f"No model found in bucket {cfg.minio.bucket_name_model}")
+    return model_store.model.model_to_string()
+
+
+# Price all the flights of input_file and write them to output_file with a predicted_price column.
+# Chunks are scored in a process pool, single threaded, at most 2 chunks per process are in memory.
+@hydra.main(version_base="1.3", config_path="../configs/batch_predict", config_name="config")
+def main(cfg: DictConfig):
+    model_str = load_model_str(cfg)
+    num_processes = cfg.get("num_processes") or os.cpu_count()
+    writer = ChunkWriter(cfg.output_file)
+
+    rows = 0
+    start = time.monotonic()
+    with futures.ProcessPoolExecutor(
+        max_workers=num_processes, initializer=init_worker, initargs=(model_str,)
+    ) as executor:
+        pending = deque()
+
+        def write_oldest():
+            nonlocal rows
+            chunk = pending.popleft().result()
+            writer.write(chunk)
+            rows += len(chunk)
+            elapsed = time.monotonic() - start
+            log.info(f"Priced {rows} rows in {elapsed:.1f}s ({rows / elapsed:.0f} rows/sec)")
+
+        for chunk in read_chunks(cfg.input_file, cfg.chunk_size):
+            if len(pending) >= 2 * num_processes:
+                write_oldest()
+            pending.append(
+                executor.submit(score_chunk, chunk, cfg.date_format, cfg.hour_format)
+            )
+        while pending:
+            write_oldest()
+    writer.close()
+
+    elapsed = time.monotonic() - start
+    log.info(
+        f"Predictions saved in {cfg.output_file}: "
+        f"{rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/sec)"
+    )
+
+
+if __name__ == "__main__":
+    main()
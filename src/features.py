@@ -0,0 +1,67 @@
+"""
+Featurization of a single flight in plain Python, for the prediction hot path.
+
+It computes the same features as `utils_predict.build_flight_df`, without
+building a DataFrame for every request.
+"""
+
+import weakref
+from datetime import datetime
+from typing import Dict, List
+
+# Categorical features, in the order of the categories LightGBM saves in `pandas_categorical`
+CATEGORICAL_FEATURES = ("source", "destination")
+
+
+def flight_features(
+    source: str, destination: str, departure_time: datetime, arrival_time: datetime
+) -> Dict[str, str | int]:
+    """
+    Computes the features of a flight, times are in UTC.
+    """
+    day = departure_time.date()
+    start_minutes = departure_time.hour * 60 + departure_time.minute
+    end_minutes = arrival_time.hour * 60 + arrival_time.minute
+    return {
+        "source": source,
+        "destination": destination,
+        "duration": end_minutes - start_minutes,
+        "hour_start_time": departure_time.hour,
+        "hour_end_time": arrival_time.hour,
+        "minutes_start_time": departure_time.minute,
+        "minutes_end_time": arrival_time.minute,
+        "dayofweek": day.weekday(),
+        "month": day.month,
+        "year": day.year,
+        "dayofyear": day.timetuple().tm_yday,
+        "dayofmonth": day.day,
+        "weekofyear": day.isocalendar().week,
+    }
+
+
+# Codes of the categories of each model, dropped with the model once it is replaced
+_codes_by_model: "weakref.WeakKeyDictionary[object, Dict[str, Dict[str, int]]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _category_codes(model) -> Dict[str, Dict[str, int]]:
+    codes = _codes_by_model.get(model)
+    if codes is None:
+        codes = _codes_by_model[model] = {
+            name: {category: code for code, category in enumerate(categories)}
+            for name, categories in zip(CATEGORICAL_FEATURES, model.pandas_categorical or [])
+        }
+    return codes
+
+
+def encode_flight(model, features: Dict[str, str | int]) -> List[float]:
+    """
+    Encodes the features of a flight as a row of the model input, in the order
+    of the model features. Categories unknown to the model are missing values.
+    """
+    codes = _category_codes(model)
+    return [
+        float(codes[name].get(features[name], "nan")) if name in codes else float(features[name])
+        for name in model.feature_name()
+    ]
@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent import futures
+
+_local = threading.local()
+
+
+def _run_timed(enqueued: float, fn, *args, **kwargs):
+    _local.queue_delay = time.monotonic() - enqueued
+    return fn(*args, **kwargs)
+
+
+def current_queue_delay() -> float:
+    """
+    Seconds the task running in the current thread waited in the executor queue.
+    """
+    return getattr(_local, "queue_delay", 0.0)
+
+
+class QueueTimingExecutor(futures.ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor recording how long each task waited before running,
+    readable from the task itself with `current_queue_delay`.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(_run_timed, time.monotonic(), fn, *args, **kwargs)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limits the requests processed concurrently, adapting the limit to the queueing delay.
+
+    The limit grows by one every `limit` requests served within the target delay
+    (additive increase) and is cut by `backoff` when a request waited longer
+    (multiplicative decrease). Requests that waited longer than the target, or that
+    arrive when the limit is reached, are rejected so the queue drains instead of
+    serving requests whose clients already gave up.
+
+    Args:
+        target_delay (float): The target queueing delay in seconds.
+        min_limit (int): The lowest concurrency limit.
+        max_limit (int): The highest concurrency limit, usually the number of server threads.
+        backoff (float, optional): The factor applied to the limit on overload. Defaults to 0.9.
+    """
+
+    def __init__(self, target_delay: float, min_limit: int, max_limit: int, backoff: float = 0.9):
+        self.target_delay = target_delay
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, queue_delay: float) -> bool:
+        with self._lock:
+            if queue_delay > self.target_delay:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                return False
+            if self.in_flight >= int(self.limit):
+                return False
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
+
+# lightgbm (with numpy and pandas) is imported by the first model load, so the
+# predict server can start while it loads
+if TYPE_CHECKING:
+    import lightgbm as lgb
+    from minio import Minio
+
+log = logging.getLogger(__name__)
+
+
+def creation_time(creation_date: str | None) -> float:
+    if creation_date is None:
+        return 0.0
+    return time.mktime(time.strptime(creation_date, "%a %b %d %H:%M:%S %Y"))
+
+
+class ModelStore:
+    model: "lgb.Booster | None"
+    candidate: "lgb.Booster | None"
+
+    def __init__(
+        self,
+        minio_client: "Minio | None",
+        minio_bucket_name_model: str,
+        reload_debounce: float = 0.0,
+        shadow_new_models: bool = False,
+    ):
+        self.minio_client = minio_client
+        self.bucket_name = minio_bucket_name_model
+        self.model = None
+        self.model_name = None
+        self.model_etag = None
+        self.model_created = 0.0
+        self.listeners = []
+
+        # With shadow_new_models, reloaded models become the candidate, scored
+        # alongside the active model until promote_candidate is called
+        self.shadow_new_models = shadow_new_models
+        self.candidate = None
+        self.candidate_name = None
+        self.candidate_etag = None
+        self.candidate_created = 0.0
+
+        # Reload requests received within reload_debounce seconds are coalesced
+        self.reload_debounce = reload_debounce
+        self._pending = set()
+        self._timer = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+
+    def add_listener(self, listener: Callable[[str], None]):
+        """Registers a function called with the model name every time a model is loaded."""
+        self.listeners.append(listener)
+
+    def load_latest_model(self):
+        """
+        Loads the newest model of the bucket. The initial load runs alongside the
+        event listener, so it is skipped if a model at least as new is already loaded.
+        """
+        objects = self.minio_client.list_objects(self.bucket_name, include_user_meta=True)
+        all_files = [
+            (o.object_name, o.etag, creation_time(o.metadata["X-Amz-Meta-Creation-Date"]))
+            for o in objects
+        ]
+
+        if len(all_files) == 0:
+            log.warning("No files found in the bucket")
+            return
+        file_name, etag, created = max(all_files, key=lambda x: x[2])
+        with self._reload_lock:
+            if etag in (self.model_etag, self.candidate_etag):
+                log.info(f"Model {file_name} already loaded, skipping")
+            elif created < max(self.model_created, self.candidate_created):
+                log.info(f"Model {file_name} is older than the loaded models, skipping")
+            else:
+                self.load_model(file_name)
+
+    def _download(self, model_name: str):
+        import lightgbm as lgb
+
+        response = self.minio_client.get_object(
+            bucket_name=self.bucket_name,
+            object_name=model_name,
+        )
+        try:
+            log.info(f"Model downloaded: {model_name}")
+            model = lgb.Booster(model_str=response.read(decode_content=True).decode())
+            etag = response.headers.get("etag", "").replace('"', "")
+            created = creation_time(response.headers.get("x-amz-meta-creation-date"))
+        finally:
+            response.close()
+            response.release_conn()
+        return model, etag, created
+
+    def load_model(self, model_name: str):
+        model, etag, created = self._download(model_name)
+        self.model = model
+        self.model_name = model_name
+        self.model_etag = etag
+        self.model_created = created
+        self._notify(model_name)
+
+    def load_candidate(self, model_name: str):
+        model, etag, created = self._download(model_name)
+        self.candidate = model
+        self.candidate_name = model_name
+        self.candidate_etag = etag
+        self.candidate_created = created
+        log.info(f"Candidate model loaded: {model_name}, active model: {self.model_name}")
+
+    def promote_candidate(self):
+        """Makes the candidate the active model."""
+        with self._reload_lock:
+            if self.candidate is None:
+                log.warning("No candidate model to promote")
+                return
+            self.model = self.candidate
+            self.model_name = self.candidate_name
+            self.model_etag = self.candidate_etag
+            self.model_created = self.candidate_created
+            self.candidate = None
+            self.candidate_name = None
+            self.candidate_etag = None
+            self.candidate_created = 0.0
+        log.info(f"Candidate model promoted: {self.model_name}")
+        self._notify(self.model_name)
+
+    def load_model_file(self, file_path: str):
+        """Loads a model from a local file, bypassing MinIO."""
+        import lightgbm as lgb
+
+        self.model = lgb.Booster(model_file=file_path)
+        self.model_name = file_path
+        log.info(f"Model loaded: {file_path}")
+        self._notify(file_path)
+
+    def _notify(self, model_name: str):
+        for listener in self.listeners:
+            listener(model_name)
+
+    def request_reload(self, model_name: str):
+        """
+        Schedules the load of a model announced by a bucket event. Requests are
+        coalesced over the debounce window, then only the newest announced model
+        is loaded, if it differs from the loaded one and is not older.
+        """
+        with self._lock:
+            self._pending.add(model_name)
+            # The window starts at the first request, so a steady stream of
+            # events cannot postpone the reload indefinitely
+            if self._timer is None:
+                self._timer = threading.Timer(self.reload_debounce, self._reload_pending)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _reload_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            self._timer = None
+        # A new window may close while the previous model is still loading
+        with self._reload_lock:
+            self._reload_newest(pending)
+
+    def _reload_newest(self, pending: set):
+        # A model deleted after its event must not hide the other announced models
+        candidates = []
+        for name in pending:
+            try:
+                candidates.append(self.minio_client.stat_object(self.bucket_name, name))
+            except Exception:
+                log.exception(f"Error checking model {name}, skipping")
+        if not candidates:
+            return
+        newest = max(
+            candidates, key=lambda o: creation_time(o.metadata.get("x-amz-meta-creation-date"))
+        )
+        created = creation_time(newest.metadata.get("x-amz-meta-creation-date"))
+        # Without an active model, a new model is served right away
+        as_candidate = self.shadow_new_models and self.model is not None
+
+        if newest.etag in (self.model_etag, self.candidate_etag):
+            log.info(f"Model {newest.object_name} already loaded, skipping")
+        elif created < max(self.model_created, self.candidate_created):
+            log.info(f"Model {newest.object_name} is older than the loaded models, skipping")
+        else:
+            if len(pending) > 1:
+                log.info(f"Coalesced {len(pending)} reload events into {newest.object_name}")
+            try:
+                if as_candidate:
+                    self.load_candidate(newest.object_name)
+                else:
+                    self.load_model(newest.object_name)
+            except Exception:
+                log.exception(f"Error loading model {newest.object_name}")
@@ -1,60 +1,92 @@
 import json
 import logging
+import os
+import sys
+import signal
 import threading
 import time
 import traceback as tb
-from concurrent import futures
 from functools import partial
 from math import modf
+from typing import TYPE_CHECKING
 
-from dotenv import load_dotenv
 import grpc
-import hydra
-import lightgbm as lgb
-import numpy as np
-import pandas as pd
-import pika
-from minio import Minio
-from omegaconf import DictConfig
+from dotenv import load_dotenv
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 
+import priceest.prices_pb2 as prices_pb2
 import priceest.prices_pb2_grpc as prices_pb2_grpc
 from priceest.prices_pb2 import EstimatePriceRequest, EstimatePriceResponse
-from utils_predict import build_flight_df
+from features import encode_flight, flight_features
+from load_shedding import (AdaptiveConcurrencyLimiter, QueueTimingExecutor,
+                           current_queue_delay)
+from model_store import ModelStore
+from profiling import SignalProfiler
+from shadow import ShadowScorer
+
+# Startup time matters for autoscaling: hydra, minio, pika and lightgbm (with
+# numpy and pandas) are imported only where they are used, see tests/bench_startup.py
+if TYPE_CHECKING:
+    from omegaconf import DictConfig
 
 log = logging.getLogger(__name__)
 
 
 class PriceEstimation(prices_pb2_grpc.PriceEstimationServicer):
-    def __init__(self, model_store: 'ModelStore'):
+    def __init__(
+        self,
+        model_store: ModelStore,
+        limiter: AdaptiveConcurrencyLimiter,
+        min_deadline: float,
+        shadow: ShadowScorer | None = None,
+    ):
         super().__init__()
         self.model_store = model_store
+        self.limiter = limiter
+        self.min_deadline = min_deadline
+        self.shadow = shadow
+
+    def check_deadline(self, context: grpc.ServicerContext, stage: str):
+        # Fail fast instead of computing a price the client will never receive
+        remaining = context.time_remaining()
+        if remaining is not None and remaining < self.min_deadline:
+            raise context.abort(
+                grpc.StatusCode.DEADLINE_EXCEEDED, f"Deadline exceeded before {stage}"
+            )
 
     def EstimatePrice(
         self, request: EstimatePriceRequest, context: grpc.ServicerContext
     ) -> EstimatePriceResponse:
 
-        if self.model_store.model is None:
+        # The model may be swapped by a reload while the request is served
+        model, model_name = self.model_store.model, self.model_store.model_name
+        if model is None:
             raise context.abort(grpc.StatusCode.UNAVAILABLE, "Model not found")
 
-        source = request.flight.source
-        destination = request.flight.destination
-        departure_time = request.flight.departure_time.ToDatetime()
-        arrival_time = request.flight.arrival_time.ToDatetime()
-
-        date = departure_time.strftime("%Y-%m-%d")
-        start_time = departure_time.strftime("%H:%M")
-        end_time = arrival_time.strftime("%H:%M")
+        if not self.limiter.try_acquire(current_queue_delay()):
+            raise context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Server overloaded")
+        try:
+            self.check_deadline(context, "featurizing")
 
-        flight_detail = {
-            "date": [date],
-            "source": [source],
-            "destination": [destination],
-            "start_time": [start_time],
-            "end_time": [end_time],
-        }
+            features = flight_features(
+                request.flight.source,
+                request.flight.destination,
+                request.flight.departure_time.ToDatetime(),
+                request.flight.arrival_time.ToDatetime(),
+            )
+            self.check_deadline(context, "predicting")
+            start = time.perf_counter()
+            price = model.predict([encode_flight(model, features)])
+            latency = time.perf_counter() - start
+        finally:
+            self.limiter.release()
 
-        df = build_flight_df(pd.DataFrame(flight_detail), hour_format="%H:%M")
-        price = self.model_store.model.predict(df)
+        if self.shadow is not None:
+            # Only a sampled fraction is scored by the candidate, after the response is computed
+            self.shadow.observe(model_name, latency)
+            candidate, candidate_name = self.model_store.candidate, self.model_store.candidate_name
+            if candidate is not None:
+                self.shadow.maybe_score(candidate, candidate_name, features, price[0])
 
         response = EstimatePriceResponse()
         response.price.currency_code = "USD"
@@ -65,57 +97,66 @@ class PriceEstimation(prices_pb2_grpc.PriceEstimationServicer):
         return response
 
 
-class ModelStore:
-    model: lgb.Booster | None
-
-    def __init__(self, minio_client: Minio, minio_bucket_name_model: str):
-        self.minio_client = minio_client
-        self.bucket_name = minio_bucket_name_model
-        self.model = None
-
-    def load_latest_model(self):
-        objects = self.minio_client.list_objects(self.bucket_name, include_user_meta=True)
-        all_files = [
-            (
-                o.object_name,
-                time.mktime(time.strptime(o.metadata["X-Amz-Meta-Creation-Date"], "%a %b %d %H:%M:%S %Y")),
-            )
-            for o in objects
-        ]
-
-        if len(all_files) == 0:
-            log.warning("No files found in the bucket")
-        else:
-            file_name = max(all_files, key=lambda x: x[1])[0]
-            self.load_model(file_name)
-
-    def load_model(self, model_name: str):
-        try:
-            response = self.minio_client.get_object(
-                bucket_name=self.bucket_name,
-                object_name=model_name,
-            )
-            log.info(f"Model downloaded: {model_name}")
-            self.model = lgb.Booster(model_str=response.read(decode_content=True).decode())
-        finally:
-            response.close()
-            response.release_conn()
-
-
-def grpc_serve(model_store: ModelStore):
-    model_store.load_latest_model()
-    app = PriceEstimation(model_store)
+# Start the gRPC server without waiting for a model, it is healthy once a model is loaded.
+def grpc_serve(
+    model_store: ModelStore, server_cfg: "DictConfig", shadow: ShadowScorer | None = None
+) -> grpc.Server:
+    max_workers = server_cfg.max_workers
+    shedding = server_cfg.load_shedding
+
+    # The health service reports NOT_SERVING until a model is loaded
+    health_servicer = health.HealthServicer()
+    service_name = prices_pb2.DESCRIPTOR.services_by_name["PriceEstimation"].full_name
+
+    def set_health(_model_name: str):
+        for service in ("", service_name):
+            health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+
+    for service in ("", service_name):
+        health_servicer.set(service, health_pb2.HealthCheckResponse.NOT_SERVING)
+    model_store.add_listener(set_health)
+
+    app = PriceEstimation(
+        model_store,
+        AdaptiveConcurrencyLimiter(
+            target_delay=shedding.target_queue_delay_ms / 1000,
+            min_limit=shedding.min_concurrency,
+            max_limit=max_workers,
+        ),
+        min_deadline=shedding.min_deadline_ms / 1000,
+        shadow=shadow,
+    )
 
-    port = "50051"
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    port = str(server_cfg.port)
+    server = grpc.server(
+        QueueTimingExecutor(max_workers=max_workers),
+        maximum_concurrent_rpcs=server_cfg.max_concurrent_rpcs,
+    )
     prices_pb2_grpc.add_PriceEstimationServicer_to_server(app, server)
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
     server.add_insecure_port("[::]:" + port)
     server.start()
     log.info("GRPC server started, listening on " + port)
-    server.wait_for_termination()
+    return server
+
+
+# Load the model served at startup, the server is stopped if it cannot be loaded.
+def load_initial_model(model_store: ModelStore, server: grpc.Server, cfg: "DictConfig"):
+    try:
+        if cfg.get("model_file"):
+            model_store.load_model_file(cfg.model_file)
+            return
+        if not model_store.minio_client.bucket_exists(cfg.minio.bucket_name_model):
+            raise Exception(f"Bucket {cfg.minio.bucket_name_model} do not exist")
+        model_store.load_latest_model()
+    except Exception:
+        log.exception("Error loading the model, stopping the server")
+        server.stop(grace=None)
 
 
 def rabbitmq_listen(args: dict):
+    import pika
+
     connection_rabbitmq = pika.BlockingConnection(
         pika.ConnectionParameters(host="rabbitmq")
     )
@@ -143,42 +184,91 @@ def consume_callback(ch, method, properties, body, args):
         bucket_name_pred = body["Records"][0]["s3"]["bucket"]["name"]
         log.info(f" [*] Received message for {obj_name_pred} in bucket {bucket_name_pred}")
 
-        model_store.load_model(obj_name_pred)
+        model_store.request_reload(obj_name_pred)
 
     except:
         log.exception(f"Error processing AMQP event {body=}")
 
 
-# Download the model from MinIO and start prediction server.
+# Start the prediction server while the model is downloaded from MinIO.
 # If the model in not found in MinIO, wait for a message from RabbitMQ.
-@hydra.main(version_base="1.3", config_path="../configs/predict", config_name="config")
-def main(cfg: DictConfig):
+def run(cfg: "DictConfig"):
     load_dotenv()
+    SignalProfiler(**cfg.profiling).install()
+
+    if cfg.get("model_file"):
+        # A local model is served as is, without MinIO and reload events
+        model_store = ModelStore(None, None)
+    else:
+        from minio import Minio
+
+        minio_client = Minio(
+            endpoint=cfg.minio.endpoint,
+            access_key=cfg.minio.access_key,
+            secret_key=cfg.minio.secret_key,
+            secure=cfg.minio.secure_connection,
+        )
+        model_store = ModelStore(
+            minio_client,
+            cfg.minio.bucket_name_model,
+            cfg.reload_debounce_seconds,
+            shadow_new_models=cfg.shadow.enabled,
+        )
+
+    shadow = None
+    if cfg.shadow.enabled:
+        shadow = ShadowScorer(
+            sample_rate=cfg.shadow.sample_rate,
+            max_workers=cfg.shadow.max_workers,
+            max_pending=cfg.shadow.max_pending,
+            report_interval=cfg.shadow.report_interval,
+        )
+        # Promotion waits for a reload in progress, so it does not run in the signal handler
+        signal.signal(
+            signal.SIGUSR2,
+            lambda signum, frame: threading.Thread(target=model_store.promote_candidate).start(),
+        )
+        log.info(f"Send signal SIGUSR2 to process {os.getpid()} to promote the candidate model")
+
+    server = grpc_serve(model_store, cfg.server, shadow)
+    threading.Thread(
+        target=load_initial_model,
+        kwargs={'model_store': model_store, 'server': server, 'cfg': cfg},
+        daemon=True,
+    ).start()
+    if not cfg.get("model_file"):
+        threading.Thread(
+            target=rabbitmq_listen,
+            kwargs={'args': {'model_store': model_store}},
+            daemon=True,
+        ).start()
 
-    minio_client = Minio(
-        endpoint=cfg.minio.endpoint,
-        access_key=cfg.minio.access_key,
-        secret_key=cfg.minio.secret_key,
-        secure=cfg.minio.secure_connection,
-    )
-    if not minio_client.bucket_exists(cfg.minio.bucket_name_model):
-        raise Exception(f"Bucket {cfg.minio.bucket_name_model} do not exist")
+    server.wait_for_termination()
+
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configs", "predict")
+
+
+# Load the config without hydra, whose config composition is only needed for overrides.
+def load_config() -> "DictConfig":
+    from omegaconf import OmegaConf
 
-    model_store = ModelStore(minio_client, cfg.minio.bucket_name_model)
+    cfg = OmegaConf.load(os.path.join(CONFIG_DIR, "config.yaml"))
+    # Resolved by hydra when it composes the config
+    cfg.cwd = os.getcwd()
+    return cfg
 
-    grpc_service_thread = threading.Thread(
-        target=grpc_serve,
-        kwargs={'model_store': model_store})
-    rabbitmq_service_thread = threading.Thread(
-        target=rabbitmq_listen,
-        kwargs={'args': {'model_store': model_store}})
 
-    log.info("Threads starting...")
-    grpc_service_thread.start()
-    rabbitmq_service_thread.start()
+def main():
+    if len(sys.argv) > 1:
+        import hydra
 
-    grpc_service_thread.join()
-    rabbitmq_service_thread.join()
+        hydra.main(version_base="1.3", config_path="../configs/predict", config_name="config")(run)()
+    else:
+        logging.basicConfig(
+            level=logging.INFO, format="[%(asctime)s][%(name)s][%(levelname)s] - %(message)s"
+        )
+        run(load_config())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+import contextlib
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterator
+
+log = logging.getLogger(__name__)
+
+
+def collapse_stack(frame, thread_name: str) -> str:
+    """
+    Formats a stack as a line of the collapsed-stack format used by flamegraph tools,
+    from the thread name down to the innermost frame, separated by ";".
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+def sample_stacks(duration: float, interval: float) -> Counter:
+    """
+    Samples the stacks of all the other threads every interval seconds, for duration seconds.
+
+    Returns:
+        Counter: The number of samples of every collapsed stack.
+    """
+    samples = Counter()
+    own_id = threading.get_ident()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_id:
+                samples[collapse_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+        time.sleep(interval)
+    return samples
+
+
+def write_collapsed(samples: Counter, file_path: str):
+    with open(file_path, "w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+class SignalProfiler:
+    """
+    Captures a time-bounded sampling profile of the process when it receives a signal,
+    e.g. `kill -USR1 <pid>`, and writes it as a collapsed-stack file in output_dir
+    (render it with flamegraph.pl or speedscope). Nothing runs until the signal arrives.
+
+    Args:
+        output_dir (str): The directory of the profiles.
+        duration (float): The seconds of every capture.
+        interval (float): The seconds between two samples.
+    """
+
+    def __init__(self, output_dir: str, duration: float, interval: float):
+        self.output_dir = output_dir
+        self.duration = duration
+        self.interval = interval
+        self._capture = None
+
+    def install(self, signum: int = signal.SIGUSR1):
+        # Signal handlers can only be installed from the main thread
+        signal.signal(signum, self._on_signal)
+        log.info(f"Send signal {signal.Signals(signum).name} to process {os.getpid()} to profile it")
+
+    def _on_signal(self, signum, frame):
+        if self._capture is not None and self._capture.is_alive():
+            log.warning("Profile capture already running, signal ignored")
+            return
+        self._capture = threading.Thread(target=self.capture, name="profiler", daemon=True)
+        self._capture.start()
+
+    def capture(self) -> str:
+        log.info(f"Profiling for {self.duration}s")
+        samples = sample_stacks(self.duration, self.interval)
+        os.makedirs(self.output_dir, exist_ok=True)
+        file_path = os.path.join(
+            self.output_dir,
+            f"profile_{os.getpid()}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.collapsed",
+        )
+        write_collapsed(samples, file_path)
+        log.info(f"Profile with {sum(samples.values())} samples saved in {file_path}")
+        return file_path
+
+
+class RunReport:
+    """
+    Collects the duration of the stages of a run, and any other field, in a structured report.
+    """
+
+    def __init__(self, **fields):
+        self.fields = dict(fields)
+        self.spans: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[name] = self.spans.get(name, 0.0) + time.perf_counter() - start
+
+    def to_json(self) -> str:
+        return json.dumps({**self.fields, "spans_s": {k: round(v, 4) for k, v in self.spans.items()}})
@@ -0,0 +1,108 @@
+"""
+This module implements a streaming reduction of the training data: exact
+duplicate rows are dropped, and the rows of every (route, date) group are
+capped by reservoir sampling, with sample weights preserving the group sizes.
+
+"""
+
+import logging
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+GROUP_COLUMNS = ["source", "destination", "date"]
+
+
+class HashSet:
+    """
+    Set of 64-bit row hashes, kept as a sorted numpy array (8 bytes per row).
+    """
+
+    def __init__(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def add_new(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Adds hashes to the set.
+
+        Returns:
+            np.ndarray: The mask of the hashes not in the set, first occurrence only.
+        """
+        new = np.zeros(len(hashes), dtype=bool)
+        unique, first = np.unique(hashes, return_index=True)
+        position = np.searchsorted(self.hashes, unique).clip(max=len(self.hashes) - 1)
+        seen = (
+            self.hashes[position] == unique if len(self.hashes) else np.zeros(len(unique), bool)
+        )
+        new[first[~seen]] = True
+        self.hashes = np.union1d(self.hashes, unique[~seen])
+        return new
+
+
+def reduce_training_data(
+    data, max_rows_per_group: int, chunk_size: int = 100_000, seed: int = 0
+) -> Tuple[pd.DataFrame, pd.Series, dict]:
+    """
+    Reads a scraped CSV in chunks, drops the exact duplicate rows, and keeps at
+    most max_rows_per_group rows per (source, destination, date).
+
+    Every row gets a random priority, and the rows of the lowest priorities of
+    each group are kept across chunks: a uniform reservoir sample of the group.
+    A kept row weighs the distinct rows of its group divided by the kept rows,
+    so the total weight of a group is its distinct row count.
+    The columns are read as strings: dtypes inferred per chunk would make the
+    hash of a row depend on the chunk it falls in.
+
+    Args:
+        data: A path or a file-like object of the CSV (";" separated).
+        max_rows_per_group (int): The highest number of rows kept per group.
+        chunk_size (int, optional): The rows read at once. Defaults to 100_000.
+        seed (int, optional): The seed of the priorities. Defaults to 0.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.Series, dict]: The kept rows in input order (string
+        columns), their sample weights, and the counts of the reduction.
+    """
+    rng = np.random.default_rng(seed)
+    seen = HashSet()
+    kept = None
+    group_rows = None
+    rows_in = 0
+
+    for chunk in pd.read_csv(data, sep=";", header=0, dtype=str, chunksize=chunk_size):
+        hashes = pd.util.hash_pandas_object(chunk, index=False).to_numpy()
+        order = np.arange(rows_in, rows_in + len(chunk))
+        rows_in += len(chunk)
+        new = seen.add_new(hashes)
+        chunk = chunk[new].assign(_order=order[new], _priority=rng.random(new.sum()))
+        sizes = chunk.groupby(GROUP_COLUMNS, dropna=False).size()
+        group_rows = sizes if group_rows is None else group_rows.add(sizes, fill_value=0)
+
+        kept = chunk if kept is None else pd.concat([kept, chunk])
+        kept = kept.sort_values("_priority").groupby(GROUP_COLUMNS, dropna=False).head(
+            max_rows_per_group
+        )
+
+    if kept is None:
+        raise Exception("No training data")
+    kept = kept.sort_values("_order")
+    sizes = kept.groupby(GROUP_COLUMNS, dropna=False)[GROUP_COLUMNS[0]].transform("size")
+    totals = group_rows.reindex(pd.MultiIndex.from_frame(kept[GROUP_COLUMNS])).to_numpy()
+    # LightGBM takes float32 weights
+    weights = pd.Series(
+        (totals / sizes.to_numpy()).astype("float32"), index=kept.index, name="weight"
+    )
+    kept = kept.drop(columns=["_order", "_priority"])
+
+    stats = dict(
+        rows_in=rows_in,
+        rows_distinct=int(group_rows.sum()),
+        rows_out=len(kept),
+        groups=len(group_rows),
+        reduction_ratio=round(len(kept) / rows_in, 4) if rows_in else 1.0,
+    )
+    log.info("Reduced training data: " + " ".join(f"{k}={v}" for k, v in stats.items()))
+    return kept, weights, stats
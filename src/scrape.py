@@ -1,26 +1,328 @@
 import asyncio
+import contextlib
+import io
 import json
 import logging
 import os
+import socket
+import time
+from collections import defaultdict, deque
 from datetime import datetime
+from functools import partial
 from time import ctime
 
 import hydra
+import pika
 from dotenv import load_dotenv
 from minio import Minio
 from omegaconf import DictConfig
 from playwright.async_api import async_playwright
 
-from progress import Progress
-from utils_scrape import (generate_date_range, generate_permutations,
-                          save_info, scrape)
+from transfer import upload
+from utils_scrape import (HostRateLimiter, PagePool, ResultWriter,
+                          ScrapeIndex, TimezoneResolver, encode_results,
+                          generate_date_range, generate_permutations,
+                          merge_partials, run_sliding_window,
+                          scrape_with_retry, sweep_partials)
 
 log = logging.getLogger(__name__)
 
-# Produce a file and upload it to MinIO.
-# Run only if force_scraping is set to True in the config file.
+TASK_QUEUE = "scrape-tasks"
+
+
+def plan_tasks(cfg: DictConfig, minio_client: Minio, skipped=frozenset()):
+    """
+    Returns a function generating the (date, source, destination) tasks to scrape,
+    the index of the scraped route-dates (None if freshness is disabled) and the planning time.
+    """
+    dates = generate_date_range(cfg.get("start_date"), cfg.get("end_date"))
+    locations = list(str.split(cfg.get("locations"), ","))
+
+    # Index of the route-dates already scraped, used to skip the fresh ones
+    freshness = cfg.get("freshness")
+    index = None
+    if freshness.enabled:
+        index = ScrapeIndex(freshness.index_file)
+        index.update_from_bucket(minio_client, cfg.minio.bucket_name_training)
+        index.save()
+    max_age = freshness.max_age_hours * 3600
+    now = time.time()
+
+    def plan():
+        return (
+            t
+            for t in generate_permutations(dates, locations)
+            if t not in skipped
+            and (index is None or index.is_stale(*t, max_age, now))
+        )
+
+    return plan, index, now
+
+
+@contextlib.asynccontextmanager
+async def scraper(cfg: DictConfig):
+    """
+    Opens the browser and the page pool, and yields a coroutine function
+    scraping an iterable of tasks with the sliding window of workers.
+    """
+    num_workers = cfg.get("num_workers")
+    with open(cfg.get("available_airports")) as f:
+        iata_codes_mapping = json.load(f)
+    with open(cfg.get("airport_timezones")) as f:
+        timezones = TimezoneResolver(iata_codes_mapping, json.load(f))
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=cfg.get("headless"))
+        async with PagePool(browser, num_workers, cfg.get("first_party_hosts")) as pool:
+            yield partial(
+                run_sliding_window,
+                num_workers=num_workers,
+                scrape_task=partial(
+                    scrape_with_retry,
+                    max_retries=cfg.get("max_retries"),
+                    backoff=cfg.get("retry_backoff"),
+                    pool=pool,
+                    timezones=timezones,
+                    rate_limiter=HostRateLimiter(cfg.get("rate_limit_interval")),
+                ),
+            )
+        await browser.close()
+
+
+def upload_dataset(cfg: DictConfig, minio_client: Minio, filename: str) -> str:
+    file_path = cfg.get("output_data_dir") + filename
+    result = upload(
+        minio_client,
+        bucket_name=cfg.minio.bucket_name_training,
+        object_name=filename,
+        data=file_path,
+        content_type="application/csv",
+        metadata={"creation-date": ctime(os.path.getctime(file_path))},
+        **cfg.get("upload"),
+    )
+    log.info(f"Object {result.object_name} uploaded to MinIO bucket")
+    return result.object_name
+
+
+# Route-dates without nonstop flights have no row in any dataset, they are
+# recorded here (object_name None if no dataset was uploaded) to not be scraped again
+def update_index(index: ScrapeIndex | None, keys, scraped_at: float, object_name: str | None):
+    if index is not None:
+        for date, source, destination in keys:
+            index.add(date, source, destination, scraped_at)
+        if object_name is not None:
+            index.objects.add(object_name)
+        index.save()
+
+
+# Scrape the whole grid in this process and upload the result.
+async def run_standalone(cfg: DictConfig, minio_client: Minio):
+    num_workers = cfg.get("num_workers")
+
+    # Scrape the data, writing the results as soon as each task completes
+    with ResultWriter(
+        cfg.get("output_data_dir"), cfg.get("flush_every"), cfg.get("resume")
+    ) as writer:
+        plan, index, now = plan_tasks(cfg, minio_client, writer.completed)
+        n_tasks = sum(1 for _ in plan())
+        log.info(f"N. of data to retrieve:{n_tasks}; N. of workers:{num_workers}")
+
+        start = time.monotonic()
+        async with scraper(cfg) as run:
+            completed = await run(tasks=plan(), on_result=writer.write, total=n_tasks)
+    elapsed = time.monotonic() - start
+    log.info(
+        f"Scraped {completed} routes in {elapsed:.0f}s " +
+        f"({completed / max(elapsed, 1e-9) * 60:.1f} routes/min)"
+    )
+
+    # Uploading a dataset triggers the training, skip it when the grid is fresh
+    if writer.n_rows == 0:
+        writer.discard()
+        update_index(index, writer.completed, now, None)
+        log.info("Grid is fresh: no new rows scraped, nothing uploaded")
+        return
+
+    gen_filename = writer.finalize()
+    log.info(f"Data saved in {cfg.get('output_data_dir')}")
+
+    object_name = upload_dataset(cfg, minio_client, gen_filename)
+    update_index(index, writer.completed, now, object_name)
+
+
+# Publish the tasks to the work queue, wait until the workers report all of
+# them, then merge the partial files of the workers into one dataset.
+def run_coordinator(cfg: DictConfig, minio_client: Minio):
+    bucket_name = cfg.minio.bucket_name_training
+    run_id = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    done_queue = f"scrape-done.{run_id}"
+
+    n_swept = sweep_partials(minio_client, bucket_name, f"partial/{run_id}/")
+    if n_swept:
+        log.info(f"Deleted {n_swept} partial files left by previous runs")
+
+    plan, index, now = plan_tasks(cfg, minio_client)
+
+    connection_rabbitmq = pika.BlockingConnection(
+        pika.ConnectionParameters(host="rabbitmq")
+    )
+    channel_rabbitmq = connection_rabbitmq.channel()
+    channel_rabbitmq.queue_declare(queue=TASK_QUEUE, durable=True)
+    # The queue of a crashed run is deleted by the broker once unused for done_queue_expires seconds
+    channel_rabbitmq.queue_declare(
+        queue=done_queue,
+        durable=True,
+        arguments={"x-expires": int(cfg.coordinator.done_queue_expires * 1000)},
+    )
+
+    n_tasks = 0
+    for date, source, destination in plan():
+        channel_rabbitmq.basic_publish(
+            exchange="",
+            routing_key=TASK_QUEUE,
+            body=json.dumps({"run_id": run_id, "key": [date, source, destination]}),
+            properties=pika.BasicProperties(
+                delivery_mode=pika.DeliveryMode.Persistent, reply_to=done_queue
+            ),
+        )
+        n_tasks += 1
+    log.info(f"Run {run_id}: published {n_tasks} tasks to {TASK_QUEUE}")
+
+    succeeded = set()
+    reported = set()
+    start = time.monotonic()
+    if n_tasks > 0:
+        for method, properties, body in channel_rabbitmq.consume(done_queue):
+            report = json.loads(body)
+            key = tuple(report["key"])
+            reported.add(key)
+            if report["ok"]:
+                succeeded.add(key)
+            channel_rabbitmq.basic_ack(method.delivery_tag)
+
+            rate = len(reported) / max(time.monotonic() - start, 1e-9) * 60
+            log.info(f"Progress: {len(reported)}/{n_tasks} routes - {rate:.1f} routes/min")
+            if len(reported) >= n_tasks:
+                break
+        channel_rabbitmq.cancel()
+    channel_rabbitmq.queue_delete(queue=done_queue)
+    connection_rabbitmq.close()
+    log.info(f"Run {run_id}: {len(succeeded)} tasks succeeded, {n_tasks - len(succeeded)} failed")
+
+    gen_filename = run_id + ".csv"
+    file_path = cfg.get("output_data_dir") + gen_filename
+    n_partials = merge_partials(minio_client, bucket_name, f"partial/{run_id}/", file_path)
+    log.info(f"Merged {n_partials} partial files in {gen_filename}")
+
+    # Uploading a dataset triggers the training, skip it when the grid is fresh
+    with open(file_path) as f:
+        n_rows = sum(1 for _ in f) - 1
+    if not succeeded or n_rows == 0:
+        os.remove(file_path)
+        update_index(index, succeeded, now, None)
+        log.info(f"Run {run_id}: grid is fresh, no new rows scraped, nothing uploaded")
+        return
 
+    object_name = upload_dataset(cfg, minio_client, gen_filename)
+    update_index(index, succeeded, now, object_name)
+
+
+# Consume tasks from the work queue, feeding the sliding window as soon as they
+# are delivered, with at most prefetch tasks unacknowledged. The rows of a task
+# are uploaded as a partial file named after its key before the task is reported
+# and acknowledged, so the tasks of a crashed worker are delivered again to
+# another one, which overwrites their partial files. A failed task is published
+# again, so that any replica can retry it, until max_deliveries is reached.
+async def run_worker(cfg: DictConfig, minio_client: Minio):
+    bucket_name = cfg.minio.bucket_name_training
+    max_deliveries = cfg.worker.max_deliveries
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    connection_rabbitmq = pika.BlockingConnection(
+        pika.ConnectionParameters(host="rabbitmq")
+    )
+    channel_rabbitmq = connection_rabbitmq.channel()
+    channel_rabbitmq.queue_declare(queue=TASK_QUEUE, durable=True)
+    channel_rabbitmq.basic_qos(prefetch_count=cfg.worker.prefetch)
+
+    received = asyncio.Queue()
+    # Deliveries of the tasks in flight by key, a key may be in flight for two runs
+    in_flight = defaultdict(deque)
+
+    def on_message(channel, method, properties, body):
+        received.put_nowait((method, properties, json.loads(body)))
+
+    channel_rabbitmq.basic_consume(TASK_QUEUE, on_message_callback=on_message)
+    log.info(f"Worker {worker_id} waiting for tasks. To exit press CTRL+C")
+
+    # The connection is serviced from the event loop, heartbeats included
+    async def pump():
+        while True:
+            connection_rabbitmq.process_data_events(time_limit=0)
+            await asyncio.sleep(cfg.worker.poll_interval)
+
+    async def tasks():
+        while True:
+            delivery = await received.get()
+            key = tuple(delivery[2]["key"])
+            in_flight[key].append(delivery)
+            yield key
+
+    def pop_delivery(key):
+        delivery = in_flight[key].popleft()
+        if not in_flight[key]:
+            del in_flight[key]
+        return delivery
+
+    def report(delivery, ok: bool):
+        method, properties, task = delivery
+        channel_rabbitmq.basic_publish(
+            exchange="",
+            routing_key=properties.reply_to,
+            body=json.dumps({"key": task["key"], "ok": ok}),
+            properties=pika.BasicProperties(delivery_mode=pika.DeliveryMode.Persistent),
+        )
+        channel_rabbitmq.basic_ack(method.delivery_tag)
 
+    def on_result(result):
+        delivery = pop_delivery(tuple(result[:3]))
+        data = encode_results([result])
+        minio_client.put_object(
+            bucket_name=bucket_name,
+            object_name=f"partial/{delivery[2]['run_id']}/{'_'.join(result[:3])}.csv.part",
+            data=io.BytesIO(data),
+            length=len(data),
+            content_type="application/csv",
+        )
+        report(delivery, ok=True)
+
+    def on_failure(key):
+        method, properties, task = delivery = pop_delivery(key)
+        deliveries = task.get("deliveries", 1)
+        if deliveries >= max_deliveries:
+            log.error(f"Worker {worker_id}: task {key} failed {deliveries} times, reported as failed")
+            report(delivery, ok=False)
+            return
+        # Published again before the ack, a crash in between only duplicates the task
+        channel_rabbitmq.basic_publish(
+            exchange="",
+            routing_key=TASK_QUEUE,
+            body=json.dumps({**task, "deliveries": deliveries + 1}),
+            properties=pika.BasicProperties(
+                delivery_mode=pika.DeliveryMode.Persistent, reply_to=properties.reply_to
+            ),
+        )
+        channel_rabbitmq.basic_ack(method.delivery_tag)
+        log.warning(f"Worker {worker_id}: task {key} failed, published again ({deliveries}/{max_deliveries})")
+
+    async with scraper(cfg) as run:
+        await asyncio.gather(
+            pump(), run(tasks=tasks(), on_result=on_result, on_failure=on_failure)
+        )
+
+
+# Produce a file and upload it to MinIO.
+# Run only if force_scraping is set to True in the config file.
 async def main(cfg: DictConfig):
 
     if cfg.get("force_scraping"):
@@ -35,74 +337,23 @@ async def main(cfg: DictConfig):
         if not minio_client.bucket_exists(cfg.minio.bucket_name_training):
             raise Exception(f"Bucket {cfg.minio.bucket_name_training} does not exist")
 
-        # Get the configuration parameters
-        start_date = cfg.get("start_date")
-        end_date = cfg.get("end_date")
         date_format = cfg.get("date_format")
-        output_data_dir = cfg.get("output_data_dir")
-
         try:
-            datetime.strptime(start_date, date_format)
-            datetime.strptime(end_date, date_format)
+            datetime.strptime(cfg.get("start_date"), date_format)
+            datetime.strptime(cfg.get("end_date"), date_format)
         except ValueError:
             log.error(f"Invalid date format. Please use the format {date_format}")
             return
 
-        # Generate all the date range and the possible flight permutations
-        dates = generate_date_range(start_date, end_date)
-        locations = list(str.split(cfg.get("locations"), ","))
-        permutations = generate_permutations(dates, locations)
-
-        iata_codes_mapping = {}
-        num_workers = cfg.get("num_workers")
-        headless = cfg.get("headless")
-        with open(cfg.get("available_airports")) as f:
-            iata_codes_mapping = json.load(f)
-
-        # Scrape the data
-        results = []
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=headless)
-            log.info("Scraping data in chunks...")
-            log.info(
-                f"N. of data to retrieve:{len(permutations)}; N. of workers:{num_workers};" +
-                f"Total chunks:{int((len(permutations) + num_workers - 1) / num_workers)}"
-            )
-
-            for i in range(0, int((len(permutations) + num_workers - 1) / num_workers)):
-                log.info(f"CHUNK {i}")
-                results += await asyncio.gather(
-                    *[
-                        scrape(
-                            task_id=i,
-                            browser=browser,
-                            date=date,
-                            source=source,
-                            destination=destination,
-                            iata_codes_mapping=iata_codes_mapping,
-                        )
-                        for i, (date, source, destination) in enumerate(
-                            permutations[i * num_workers: (i + 1) * num_workers]
-                        )
-                    ]
-                )
-            await browser.close()
-
-        gen_filename = save_info(output_data_dir, results)
-        log.info(f"Data saved in {output_data_dir}")
-
-        # Upload the file to MinIO
-        result = minio_client.fput_object(
-            bucket_name=cfg.minio.bucket_name_training,
-            object_name=gen_filename,
-            file_path=output_data_dir + gen_filename,
-            content_type="application/csv",
-            progress=Progress(),
-            metadata={
-                "creation-date": ctime(os.path.getctime(output_data_dir + gen_filename))
-            },
-        )
-        log.info(f"\nObject {result.object_name} uploaded to MinIO bucket")
+        mode = cfg.get("mode")
+        if mode == "standalone":
+            await run_standalone(cfg, minio_client)
+        elif mode == "coordinator":
+            run_coordinator(cfg, minio_client)
+        elif mode == "worker":
+            await run_worker(cfg, minio_client)
+        else:
+            raise Exception(f"Unknown mode {mode}")
     else:
         log.warning("Scraping not forced, skipping...")
 
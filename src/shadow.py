@@ -0,0 +1,157 @@
+import bisect
+import logging
+import math
+import random
+import threading
+import time
+from concurrent import futures
+from typing import Dict, List
+
+from features import encode_flight
+
+log = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in exponential buckets, from 10 microseconds doubling up to 10 seconds.
+    """
+
+    BOUNDS: List[float] = [1e-5 * 2**i for i in range(21)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """The upper bound of the bucket of the q quantile, in seconds."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def summary(self) -> str:
+        mean = self.total / self.count if self.count else 0.0
+        return (
+            f"n={self.count} mean_ms={mean * 1000:.3f} "
+            f"p50_ms<={self.quantile(0.5) * 1000:.3f} p99_ms<={self.quantile(0.99) * 1000:.3f}"
+        )
+
+
+class PredictionDeltas:
+    """
+    Differences between the prices of a candidate model and of the active model.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_squared = 0.0
+        self.max_abs = 0.0
+
+    def record(self, delta: float):
+        self.count += 1
+        self.total += delta
+        self.total_squared += delta * delta
+        self.max_abs = max(self.max_abs, abs(delta))
+
+    def summary(self) -> str:
+        mean = self.total / self.count if self.count else 0.0
+        rms = math.sqrt(self.total_squared / self.count) if self.count else 0.0
+        return f"n={self.count} mean_delta={mean:.3f} rms_delta={rms:.3f} max_abs_delta={self.max_abs:.3f}"
+
+
+class ShadowScorer:
+    """
+    Scores a sampled fraction of the requests with the candidate model of a
+    ModelStore, on a background executor, and compares it with the active model.
+
+    The response never waits for the candidate: requests are sampled with a
+    random draw, and dropped when max_pending scorings are already queued.
+    The latency histograms of every model, and the deltas between the candidate
+    and the active prices, are logged every report_interval seconds.
+    Candidate latencies are measured on the background threads, concurrently
+    with the server, so they are comparable with the active ones under load.
+
+    Args:
+        sample_rate (float): The fraction of the requests scored by the candidate.
+        max_workers (int): The threads scoring the candidate.
+        max_pending (int): The highest number of queued scorings.
+        report_interval (float): The seconds between two reports.
+    """
+
+    def __init__(
+        self, sample_rate: float, max_workers: int, max_pending: int, report_interval: float
+    ):
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self.report_interval = report_interval
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.deltas: Dict[str, PredictionDeltas] = {}
+        self.dropped = 0
+        self._pending = 0
+        self._next_report = time.monotonic() + report_interval
+        self._lock = threading.Lock()
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="shadow"
+        )
+
+    def observe(self, model_name: str, latency: float):
+        """Records the latency of a prediction of the active model."""
+        with self._lock:
+            self._record_latency(model_name, latency)
+            report = time.monotonic() >= self._next_report
+            if report:
+                self._next_report = time.monotonic() + self.report_interval
+        if report:
+            self._executor.submit(self.report)
+
+    def maybe_score(self, candidate, candidate_name: str, features: dict, active_price: float):
+        """Schedules the scoring of a request by the candidate, if it is sampled."""
+        if random.random() >= self.sample_rate:
+            return
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return
+            self._pending += 1
+        self._executor.submit(self._score, candidate, candidate_name, features, active_price)
+
+    def _score(self, candidate, candidate_name: str, features: dict, active_price: float):
+        try:
+            start = time.perf_counter()
+            price = candidate.predict([encode_flight(candidate, features)])[0]
+            latency = time.perf_counter() - start
+        except Exception:
+            log.exception(f"Error scoring candidate {candidate_name}")
+            return
+        finally:
+            with self._lock:
+                self._pending -= 1
+        with self._lock:
+            self._record_latency(candidate_name, latency)
+            self.deltas.setdefault(candidate_name, PredictionDeltas()).record(price - active_price)
+
+    def _record_latency(self, model_name: str, latency: float):
+        if model_name not in self.latencies:
+            self.latencies[model_name] = LatencyHistogram()
+        self.latencies[model_name].record(latency)
+
+    def report(self):
+        with self._lock:
+            lines = [f"shadow model={name} {h.summary()}" for name, h in self.latencies.items()]
+            lines += [f"shadow candidate={name} {d.summary()}" for name, d in self.deltas.items()]
+            dropped = self.dropped
+        for line in lines:
+            log.info(line)
+        if dropped:
+            log.info(f"shadow dropped={dropped}")
@@ -0,0 +1,331 @@
+"""
+This module implements the slimming of a trained LightGBM booster before it is
+published: the text model is truncated to the best iteration, pruned and
+re-encoded, then checked against the validation set.
+
+"""
+
+import logging
+import re
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+from profiling import RunReport
+from utils_predict import rmse
+
+log = logging.getLogger(__name__)
+
+# Per split node and per leaf arrays of a tree in the text model
+_INTERNAL_KEYS = (
+    "split_feature", "split_gain", "threshold", "decision_type", "left_child",
+    "right_child", "internal_value", "internal_weight", "internal_count",
+)
+_LEAF_KEYS = ("leaf_value", "leaf_weight", "leaf_count")
+# Only used by feature importance, refit and SHAP contributions, not by predict
+_STATS_KEYS = (
+    "split_gain", "leaf_weight", "leaf_count", "internal_value", "internal_weight", "internal_count",
+)
+
+_CATEGORICAL_MASK = 1
+_DEFAULT_LEFT_MASK = 2
+_MISSING_NONE = 0
+
+
+def parse_model(text: str) -> Tuple[List[str], List[Dict[str, str]], str]:
+    """
+    Splits a LightGBM text model in its header lines, its trees, and the text after the trees.
+    """
+    head, rest = text.split("\nTree=", 1)
+    rest, tail = ("Tree=" + rest).split("end of trees", 1)
+    header = [line for line in head.split("\n") if line and not line.startswith("tree_sizes=")]
+    trees = []
+    for block in rest.split("Tree=")[1:]:
+        lines = [line for line in block.split("\n")[1:] if line]
+        trees.append(dict(line.split("=", 1) for line in lines))
+    return header, trees, "end of trees" + tail
+
+
+def format_model(header: List[str], trees: List[Dict[str, str]], tail: str) -> str:
+    blocks = [
+        f"Tree={i}\n" + "".join(f"{k}={v}\n" for k, v in tree.items()) + "\n\n"
+        for i, tree in enumerate(trees)
+    ]
+    # tree_sizes lets LightGBM parse the trees in parallel
+    sizes = " ".join(str(len(block)) for block in blocks)
+    return "\n".join(header) + f"\ntree_sizes={sizes}\n\n" + "".join(blocks) + tail
+
+
+def feature_ranges(header: List[str]) -> List[Optional[Tuple[float, float]]]:
+    """
+    The training range of every numerical feature, from `feature_infos`
+    ("[min:max]"), None for categorical and constant ("none") features.
+    """
+    infos = next(line for line in header if line.startswith("feature_infos=")).split("=", 1)[1]
+    ranges = []
+    for info in infos.split(" "):
+        if info.startswith("["):
+            low, high = info[1:-1].split(":")
+            ranges.append((float(low), float(high)))
+        else:
+            ranges.append(None)
+    return ranges
+
+
+def folded_side(
+    threshold: float, decision_type: int, feature_range: Optional[Tuple[float, float]]
+) -> Optional[bool]:
+    """
+    The side taken by every value of a numerical split (True for left), when the
+    whole training range of the feature is on one side of the threshold, else None.
+    LightGBM does not split on constant features, so their splits never need folding.
+    """
+    if decision_type & _CATEGORICAL_MASK or feature_range is None:
+        return None
+    low, high = feature_range
+    if threshold >= high:
+        left = True
+    elif threshold < low:
+        left = False
+    else:
+        return None
+    # Missing values must take the same side
+    missing_type = (decision_type >> 2) & 3
+    if missing_type == _MISSING_NONE:
+        missing_left = 0.0 <= threshold
+    else:
+        missing_left = bool(decision_type & _DEFAULT_LEFT_MASK)
+    return left if missing_left == left else None
+
+
+def prune_tree(
+    tree: Dict[str, str], ranges: List[Optional[Tuple[float, float]]], min_split_gain: float,
+    counts: Counter,
+) -> Dict[str, str]:
+    """
+    Rebuilds a tree without the splits whose side is known from the feature range
+    (folded), and without the splits with two leaves of equal value or with a gain
+    not above min_split_gain (collapsed into a leaf, the mean of the two leaves
+    weighted by their hessian).
+    """
+    if int(tree["num_leaves"]) <= 1 or tree.get("is_linear", "0") != "0":
+        return tree
+
+    nodes = {k: tree[k].split(" ") for k in _INTERNAL_KEYS + _LEAF_KEYS if k in tree}
+    new = {k: [] for k in nodes}
+
+    def add_leaf(values: Dict[str, str]) -> int:
+        for k in _LEAF_KEYS:
+            if k in new:
+                new[k].append(values[k])
+        return ~(len(new["leaf_value"]) - 1)
+
+    def pop_leaf() -> Dict[str, str]:
+        return {k: new[k].pop() for k in _LEAF_KEYS if k in new}
+
+    def visit(child: int) -> int:
+        if child < 0:
+            return add_leaf({k: nodes[k][~child] for k in _LEAF_KEYS if k in nodes})
+
+        side = folded_side(
+            float(nodes["threshold"][child]),
+            int(nodes["decision_type"][child]),
+            ranges[int(nodes["split_feature"][child])],
+        )
+        if side is not None:
+            counts["splits_folded"] += 1
+            return visit(int(nodes["left_child" if side else "right_child"][child]))
+
+        index = len(new["split_feature"])
+        for k in _INTERNAL_KEYS:
+            if k in new:
+                new[k].append(nodes[k][child])
+        left = visit(int(nodes["left_child"][child]))
+        right = visit(int(nodes["right_child"][child]))
+
+        gain = float(nodes["split_gain"][child]) if "split_gain" in nodes else np.inf
+        if left < 0 and right < 0:
+            right_leaf = pop_leaf()
+            left_leaf = pop_leaf()
+            if left_leaf["leaf_value"] == right_leaf["leaf_value"] or gain <= min_split_gain:
+                # The two leaves were the last added, and the split the last internal node
+                for k in _INTERNAL_KEYS:
+                    if k in new:
+                        new[k].pop()
+                counts["splits_pruned"] += 1
+                return add_leaf(merge_leaves(left_leaf, right_leaf))
+            left, right = add_leaf(left_leaf), add_leaf(right_leaf)
+
+        new["left_child"][index] = str(left)
+        new["right_child"][index] = str(right)
+        return index
+
+    visit(0)
+    pruned = dict(tree)
+    pruned["num_leaves"] = str(len(new["leaf_value"]))
+    for k, values in new.items():
+        pruned[k] = " ".join(values)
+    return pruned
+
+
+def merge_leaves(left: Dict[str, str], right: Dict[str, str]) -> Dict[str, str]:
+    if left["leaf_value"] == right["leaf_value"]:
+        value = float(left["leaf_value"])
+    else:
+        weights = [float(leaf.get("leaf_weight", 1.0)) for leaf in (left, right)]
+        values = [float(leaf["leaf_value"]) for leaf in (left, right)]
+        value = np.average(values, weights=weights) if sum(weights) > 0 else np.mean(values)
+    merged = {"leaf_value": repr(float(value))}
+    for k in ("leaf_weight", "leaf_count"):
+        if k in left:
+            merged[k] = repr(float(left[k]) + float(right[k]))
+    if "leaf_count" in merged:
+        merged["leaf_count"] = str(int(float(merged["leaf_count"])))
+    return merged
+
+
+def drop_constant_trees(trees: List[Dict[str, str]], counts: Counter) -> List[Dict[str, str]]:
+    """
+    Removes the single leaf trees, their value is added to the leaves of the first other tree.
+    """
+    constant = sum(float(t["leaf_value"]) for t in trees if int(t["num_leaves"]) <= 1)
+    kept = [t for t in trees if int(t["num_leaves"]) > 1]
+    if not kept or len(kept) == len(trees):
+        return trees
+    counts["trees_dropped"] += len(trees) - len(kept)
+    first = dict(kept[0])
+    first["leaf_value"] = " ".join(
+        repr(float(v) + constant) for v in first["leaf_value"].split(" ")
+    )
+    return [first] + kept[1:]
+
+
+def feature_importances(header: List[str], trees: List[Dict[str, str]]) -> str:
+    names = next(line for line in header if line.startswith("feature_names=")).split("=", 1)[1]
+    names = names.split(" ")
+    splits = Counter(
+        names[int(f)] for t in trees if t.get("split_feature") for f in t["split_feature"].split(" ")
+    )
+    return "".join(f"{name}={count}\n" for name, count in splits.most_common())
+
+
+def slim_text(
+    text: str, min_split_gain: float = 0.0, drop_stats: bool = True
+) -> Tuple[str, Counter]:
+    """
+    Prunes and re-encodes a LightGBM text model, see `slim_model`.
+
+    Returns:
+        Tuple[str, Counter]: The slimmed text model and the count of the removed parts.
+    """
+    header, trees, tail = parse_model(text)
+    counts = Counter()
+    ranges = feature_ranges(header)
+    trees = [prune_tree(t, ranges, min_split_gain, counts) for t in trees]
+    # Folding a constant tree into another one only keeps a sum of trees: not
+    # with several trees per iteration, nor with the average of a random forest
+    if "num_tree_per_iteration=1" in header and "average_output" not in header:
+        trees = drop_constant_trees(trees, counts)
+    if drop_stats:
+        trees = [{k: v for k, v in t.items() if k not in _STATS_KEYS} for t in trees]
+
+    # The split counts of the feature_importances section are computed again,
+    # the section is empty when no tree has a split
+    before, after = tail.split("feature_importances:\n", 1)
+    section = re.search(r"^(parameters:|pandas_categorical:)", after, re.MULTILINE)
+    tail = (
+        before + "feature_importances:\n" + feature_importances(header, trees)
+        + "\n" + (after[section.start():] if section else "")
+    )
+    return format_model(header, trees, tail), counts
+
+
+def encode(model: lgb.Booster, X: pd.DataFrame) -> np.ndarray:
+    """The rows of X as the model input, as encoded by LightGBM from a DataFrame."""
+    X = X.copy()
+    categorical = X.select_dtypes("category").columns
+    for column, categories in zip(categorical, model.pandas_categorical or []):
+        codes = X[column].cat.set_categories(categories).cat.codes
+        X[column] = codes.astype("float64").replace(-1, np.nan)
+    return X.to_numpy(dtype=np.float64)
+
+
+def predict_latency(
+    model: lgb.Booster, rows: np.ndarray, num_iteration: int | None = None, n_rows: int = 200
+) -> float:
+    """The median latency in seconds of the prediction of one row, as in the predict server."""
+    latencies = []
+    for row in rows[:n_rows]:
+        start = time.perf_counter()
+        model.predict([row], num_iteration=num_iteration)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies))
+
+
+def slim_model(
+    model: lgb.Booster,
+    X_valid: pd.DataFrame,
+    y_valid: pd.Series,
+    rmse_tolerance: float,
+    min_split_gain: float = 0.0,
+    drop_stats: bool = True,
+    report: RunReport | None = None,
+) -> lgb.Booster:
+    """
+    Returns the booster to publish: truncated to the best iteration, with the
+    splits that cannot change a prediction folded or collapsed, the splits with a
+    gain not above min_split_gain collapsed, and the single leaf trees removed.
+    With drop_stats, the split gains, weights and counts are not saved: gain
+    importance, refit and SHAP contributions are not available on the slim model.
+
+    Args:
+        model (lgb.Booster): The trained booster.
+        X_valid (pd.DataFrame): The validation features.
+        y_valid (pd.Series): The validation target.
+        rmse_tolerance (float): The largest relative change of the validation RMSE.
+        min_split_gain (float, optional): Splits with a gain not above are collapsed. Defaults to 0.
+        drop_stats (bool, optional): Drop the statistics not used by predict. Defaults to True.
+        report (RunReport | None, optional): The report of the run. Defaults to None.
+
+    Raises:
+        Exception: If the validation RMSE changed by more than rmse_tolerance, relatively.
+    """
+    report = report if report is not None else RunReport()
+    full_text = model.model_to_string(num_iteration=-1)
+    # best_iteration is 0 without early stopping, then all the iterations are kept
+    slim_text_model, counts = slim_text(
+        model.model_to_string(num_iteration=model.best_iteration),
+        min_split_gain=min_split_gain,
+        drop_stats=drop_stats,
+    )
+    slim = lgb.Booster(model_str=slim_text_model)
+
+    # The sizes and latencies are compared with the full booster, the RMSE with
+    # the booster at its best iteration, as evaluated by train
+    rows = encode(model, X_valid)
+    rmse_before = float(rmse(model.predict(rows, num_iteration=model.best_iteration), y_valid))
+    rmse_after = float(rmse(slim.predict(rows), y_valid))
+    stats = dict(
+        slim_bytes_before=len(full_text.encode()),
+        slim_bytes_after=len(slim_text_model.encode()),
+        slim_trees_before=model.num_trees(),
+        slim_trees_after=slim.num_trees(),
+        slim_latency_us_before=round(predict_latency(model, rows, num_iteration=-1) * 1e6, 1),
+        slim_latency_us_after=round(predict_latency(slim, rows) * 1e6, 1),
+        slim_rmse_before=rmse_before,
+        slim_rmse_after=rmse_after,
+        **{f"slim_{k}": v for k, v in counts.items()},
+    )
+    report.fields.update(stats)
+    log.info("Slimmed model: " + " ".join(f"{k}={v}" for k, v in stats.items()))
+
+    if abs(rmse_after - rmse_before) > rmse_tolerance * rmse_before:
+        raise Exception(
+            f"Slimmed model RMSE {rmse_after:0.3f} differs from {rmse_before:0.3f} "
+            f"by more than {rmse_tolerance:.2%}, not publishing"
+        )
+    return slim
@@ -1,6 +1,5 @@
 import json
 import logging
-import os
 import traceback as tb
 from datetime import datetime
 from functools import partial
@@ -15,45 +14,86 @@ from dotenv import load_dotenv
 from minio import Minio
 from omegaconf import DictConfig, OmegaConf
 
-from progress import Progress
+from profiling import RunReport, SignalProfiler
+from sampling import reduce_training_data
+from slim import slim_model
+from transfer import upload
 from utils_predict import build_flight_df, rmse
 
 log = logging.getLogger(__name__)
 
 
-def train(file_path, train_params: Any, date_format: str):
-    df = pd.read_csv(file_path, sep=";", header=0)
-    df = build_flight_df(df, date_format=date_format)
-
-    # Drop redundant or useless columns
-    df = df.drop(["currency"], axis=1)
-    df["price"] = df["price"].astype("float32")
-
-    split_date = str(df.index[int(len(df) * 0.8)].date())
-    train = df.loc[:split_date]
-    test = df.loc[split_date:]
-
-    # Split data into features and target
-    X_train, y_train = train.drop("price", axis=1), train["price"]
-    X_test, y_test = test.drop("price", axis=1), test["price"]
-
-    lgb_train = lgb.Dataset(X_train, y_train)
-    lgb_eval = lgb.Dataset(X_test, y_test, reference=lgb_train)
+def train(
+    data,
+    train_params: Any,
+    date_format: str,
+    report: RunReport | None = None,
+    slim_params: dict | None = None,
+    reduce_params: dict | None = None,
+):
+    report = report if report is not None else RunReport()
+
+    # data is either a path or a file-like object (e.g. a MinIO response body),
+    # a stream is downloaded while it is parsed (and reduced)
+    with report.span("download_parse"):
+        if reduce_params and reduce_params.get("enabled"):
+            params = {k: v for k, v in reduce_params.items() if k != "enabled"}
+            df, weights, stats = reduce_training_data(data, **params)
+            df["weight"] = weights
+            report.fields.update({f"reduce_{k}": v for k, v in stats.items()})
+        else:
+            df = pd.read_csv(data, sep=";", header=0)
+
+    with report.span("featurize"):
+        df = build_flight_df(df, date_format=date_format)
+
+        # Drop redundant or useless columns
+        df = df.drop(["currency"], axis=1)
+        df["price"] = df["price"].astype("float32")
+
+        split_date = str(df.index[int(len(df) * 0.8)].date())
+        train = df.loc[:split_date]
+        test = df.loc[split_date:]
+
+        # Split data into features, target and sample weights (if the data was reduced)
+        X_train, y_train = train.drop(["price", "weight"], axis=1, errors="ignore"), train["price"]
+        X_test, y_test = test.drop(["price", "weight"], axis=1, errors="ignore"), test["price"]
+        w_train, w_test = train.get("weight"), test.get("weight")
+
+    # Datasets are lazy, they are binned here rather than in the first boosting round.
+    # They get the training params, which lgb.train cannot change once they are constructed
+    with report.span("dataset_build"):
+        lgb_train = lgb.Dataset(X_train, y_train, weight=w_train, params=train_params)
+        lgb_eval = lgb.Dataset(
+            X_test, y_test, weight=w_test, reference=lgb_train, params=train_params
+        )
+        lgb_train.construct()
+        lgb_eval.construct()
 
     log.info("Starting training...")
-    model = lgb.train(
-        train_params,
-        lgb_train,
-        num_boost_round=20,
-        valid_sets=[lgb_eval],
-        callbacks=[lgb.early_stopping(stopping_rounds=5)],
-        categorical_feature="auto",
-    )
+    with report.span("boost"):
+        model = lgb.train(
+            train_params,
+            lgb_train,
+            num_boost_round=20,
+            valid_sets=[lgb_eval],
+            callbacks=[lgb.early_stopping(stopping_rounds=5)],
+            categorical_feature="auto",
+        )
 
     log.info("Starting testing...")
-    y_pred = model.predict(X_test, num_iteration=model.best_iteration)
-    score = rmse(y_pred, y_test)
+    with report.span("evaluate"):
+        y_pred = model.predict(X_test, num_iteration=model.best_iteration)
+        score = rmse(y_pred, y_test)
     log.info(f"RMSE Score on test set: {score:0.3f}")
+    report.fields.update(
+        rows=len(df), best_iteration=model.best_iteration, rmse=float(score)
+    )
+
+    if slim_params and slim_params.get("enabled"):
+        params = {k: v for k, v in slim_params.items() if k != "enabled"}
+        with report.span("slim"):
+            model = slim_model(model, X_test, y_test, report=report, **params)
 
     return model
 
@@ -61,9 +101,10 @@ def train(file_path, train_params: Any, date_format: str):
 def consume_callback(ch, method, properties, body, args):
     try:
         body = json.loads(body.decode().replace("'", '"'))
-        train_data_dir = args.get("train_data_dir")
-        model_out_dir = args.get("model_out_dir")
         date_format = args.get("date_format")
+        upload_args = args.get("upload")
+        slim_params = OmegaConf.to_object(args.get("slim"))
+        reduce_params = OmegaConf.to_object(args.get("reduce"))
         train_params = OmegaConf.to_object(args.get("train_params"))
 
         obj_name_train = body["Records"][0]["s3"]["object"]["key"]
@@ -72,34 +113,40 @@ def consume_callback(ch, method, properties, body, args):
         bucket_name_model = args.get("bucket_name_model")
 
         log.info(f" [*] Received message for {obj_name_train} in bucket {bucket_name_train}")
+        report = RunReport(data_object=obj_name_train)
 
-        result = minio_client.fget_object(
+        # Parse the object body while it is streamed, without a local copy
+        response = minio_client.get_object(
             bucket_name=bucket_name_train,
             object_name=obj_name_train,
-            file_path=train_data_dir + obj_name_train,
         )
-        if result is None:
-            raise Exception("Error downloading the file")
+        try:
+            log.info("[*] Streaming training data from MinIO")
+            model: lgb.Booster = train(
+                response, train_params, date_format, report, slim_params, reduce_params
+            )
+        finally:
+            response.close()
+            response.release_conn()
 
-        log.info("[*] File downloaded successfully")
-        model: lgb.Booster = train(
-            train_data_dir + obj_name_train, train_params, date_format
-        )
         model_name = "model_" + datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".txt"
-        model.save_model(model_out_dir + model_name)
-        log.info(f"[*] Model saved in {model_out_dir + model_name}")
-
-        result = minio_client.fput_object(
-            bucket_name=bucket_name_model,
-            object_name=model_name,
-            file_path=model_out_dir + model_name,
-            progress=Progress(),
-            content_type="application/txt",
-            metadata={
-                "creation-date": ctime(os.path.getctime(model_out_dir + model_name))
-            },
-        )
+        with report.span("serialize"):
+            model_bytes = model.model_to_string().encode()
+        log.info(f"[*] Model serialized in memory ({len(model_bytes)} bytes)")
+
+        with report.span("upload"):
+            result = upload(
+                minio_client,
+                bucket_name=bucket_name_model,
+                object_name=model_name,
+                data=model_bytes,
+                content_type="application/txt",
+                metadata={"creation-date": ctime()},
+                **upload_args,
+            )
         log.info(f"[*] Object {result.object_name} uploaded to MinIO bucket")
+        report.fields.update(model_object=model_name, model_bytes=len(model_bytes))
+        log.info(f"[*] Run report: {report.to_json()}")
     except:
         log.exception(f"Error processing AMQP event {body=}")
 
@@ -111,6 +158,7 @@ def main(cfg: DictConfig):
 
     if cfg.get("force_training"):
         load_dotenv()
+        SignalProfiler(**cfg.profiling).install()
 
         minio_client = Minio(
             endpoint=cfg.minio.endpoint,
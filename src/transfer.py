@@ -0,0 +1,122 @@
+"""
+This module implements uploads of artifacts to MinIO with parallel multipart
+parts, and a low-overhead reporter of the transfer throughput.
+
+"""
+
+import io
+import logging
+import time
+from typing import Dict, Optional
+
+from minio import Minio
+from minio.helpers import ObjectWriteResult
+
+log = logging.getLogger(__name__)
+
+_MEGABYTE = 1024 * 1024
+
+
+class TransferReporter:
+    """
+    Constructs a :class:`TransferReporter` object, to be passed as `progress`
+    to the MinIO upload methods.
+
+    It runs in the thread reading the data: no thread, queue or lock is used.
+    Every update only adds to a counter, a structured throughput line is
+    logged at most once per interval and when the transfer completes.
+
+    :param interval: Minimum seconds between two log lines.
+    """
+
+    def __init__(self, interval: float = 10.0):
+        self.interval = interval
+        self.object_name = None
+        self.total_length = 0
+        self.current_size = 0
+        self.start_time = time.monotonic()
+        self.next_report = self.start_time + interval
+
+    def set_meta(self, total_length, object_name):
+        """
+        Metadata settings for the object, called by MinIO before uploading it.
+        :param total_length: Total length of object.
+        :param object_name: Object name to be logged.
+        """
+        self.total_length = total_length
+        self.object_name = object_name
+        self.current_size = 0
+        self.start_time = time.monotonic()
+        self.next_report = self.start_time + self.interval
+
+    def update(self, size):
+        """
+        Update the transferred size, called by MinIO while uploading.
+        :param size: Number of bytes transferred since the last update.
+        """
+        self.current_size += size
+        if self.current_size >= self.total_length or time.monotonic() >= self.next_report:
+            self.report()
+
+    def report(self):
+        now = time.monotonic()
+        self.next_report = now + self.interval
+        elapsed = now - self.start_time
+        rate = self.current_size / _MEGABYTE / elapsed if elapsed else 0.0
+        percent = 100 * self.current_size / self.total_length if self.total_length else 100.0
+        log.info(
+            f"transfer object={self.object_name} bytes={self.current_size} "
+            f"total={self.total_length} percent={percent:.1f} "
+            f"elapsed_s={elapsed:.1f} rate_mb_s={rate:.2f}"
+        )
+
+
+def upload(
+    minio_client: Minio,
+    bucket_name: str,
+    object_name: str,
+    data: bytes | str,
+    content_type: str,
+    metadata: Optional[Dict[str, str]] = None,
+    part_size: int = 0,
+    num_parallel_uploads: int = 4,
+    progress_interval: Optional[float] = 10.0,
+) -> ObjectWriteResult:
+    """
+    Uploads bytes or a local file to MinIO. Objects bigger than `part_size`
+    are sent as a multipart upload with `num_parallel_uploads` parts in flight.
+
+    :param minio_client: The MinIO client.
+    :param bucket_name: Name of the bucket.
+    :param object_name: Object name in the bucket.
+    :param data: The content of the object, or the path of the file to upload.
+    :param content_type: Content type of the object.
+    :param metadata: Any additional metadata to be uploaded along with the object.
+    :param part_size: Multipart part size, 0 lets MinIO choose it.
+    :param num_parallel_uploads: Number of parts uploaded in parallel.
+    :param progress_interval: Seconds between throughput logs, None disables the reporter.
+    :return: :class:`ObjectWriteResult` object.
+    """
+    progress = TransferReporter(progress_interval) if progress_interval else None
+    if isinstance(data, str):
+        return minio_client.fput_object(
+            bucket_name=bucket_name,
+            object_name=object_name,
+            file_path=data,
+            content_type=content_type,
+            metadata=metadata,
+            progress=progress,
+            part_size=part_size,
+            num_parallel_uploads=num_parallel_uploads,
+        )
+    return minio_client.put_object(
+        bucket_name=bucket_name,
+        object_name=object_name,
+        data=io.BytesIO(data),
+        length=len(data),
+        content_type=content_type,
+        metadata=metadata,
+        progress=progress,
+        part_size=part_size,
+        num_parallel_uploads=num_parallel_uploads,
+    )
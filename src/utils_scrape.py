@@ -1,123 +1,110 @@
 import asyncio
+import contextlib
 import csv
+import functools
+import io
 import itertools
+import json
 import logging
+import os
+import time
 import traceback as tb
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Tuple
+from typing import (Any, AsyncIterable, AsyncIterator, Awaitable, Callable,
+                    Dict, Iterable, Iterator, List, Optional, Set, Tuple)
+from urllib.parse import urlparse
 from zoneinfo import ZoneInfo
 
-import geopy.geocoders
-from bs4 import BeautifulSoup
+import lxml.html
 from geopy.geocoders import Nominatim
-from playwright.async_api import Browser
+from minio import Minio
+from minio.deleteobjects import DeleteObject
+from playwright.async_api import (Browser, BrowserContext, Page, Request,
+                                  Route)
 from timezonefinder import TimezoneFinder
 
 log = logging.getLogger(__name__)
 
 
-def get_flight_times(
-    soup: BeautifulSoup, direct_flights_mask: List[bool], tz_start: str, tz_end: str
-) -> Tuple[List[str], List[str]]:
-    """
-    Get the start and end times of flights.
+# Classes of the Kayak result elements holding the flight data
+TIMES_CLASS = "vmXl vmXl-mod-variant-large"
+STOPS_CLASS = "JWEO-stops-text"
+PRICE_CLASS = "f8F1-price-text"
 
-    Args:
-        soup (BeautifulSoup): The BeautifulSoup object representing the parsed HTML.
-        direct_flights_mask (List[bool]): A list of boolean values indicating whether each flight is a direct flight or not.
-        tz_start (str): The timezone of the source location.
-        tz_end (str): The timezone of the destination location.
 
-    Returns:
-        Tuple[List[str], List[str]]: A tuple containing the start times and end times of the flights.
+def to_local_time(time_text: str, tz: str) -> str:
     """
-    times = soup("div", class_="vmXl vmXl-mod-variant-large")
-
-    start_times = []
-    end_times = []
-    for mask, s in zip(direct_flights_mask, times):
-        if mask:
-            start_time = datetime.strptime(str(s.find_all("span")[0].text), "%I:%M %p")
-            start_times.append(
-                datetime(
-                    2000,
-                    1,
-                    1,
-                    start_time.hour,
-                    start_time.minute,
-                    tzinfo=ZoneInfo(tz_start),
-                ).strftime("%H:%M%z")
-            )
-
-            # log.info("BUG: ", s.find_all("span")[2].text)
-            end_time = datetime.strptime(str(s.find_all("span")[2].text), "%I:%M %p")
-            end_times.append(
-                datetime(
-                    2000,
-                    1,
-                    1,
-                    end_time.hour,
-                    end_time.minute,
-                    tzinfo=ZoneInfo(tz_end),
-                ).strftime("%H:%M%z")
-            )
-
-    return start_times, end_times
-
-
-def get_direct_flights_mask(
-    soup: BeautifulSoup,
-):
-    """
-    Get a mask indicating whether each flight is a direct flight or not. Flights that arrives are excluded by default.
+    Converts a time shown on the page, e.g. "8:45 pm", to the "%H:%M%z" format.
 
     Args:
-        soup (BeautifulSoup): The BeautifulSoup object representing the parsed HTML.
+        time_text (str): The time as shown on the page.
+        tz (str): The timezone of the airport.
 
     Returns:
-        list: A list of boolean values indicating whether each flight is a direct flight or not.
+        str: The time with the UTC offset of the timezone.
     """
-    direct_flights = soup.find_all("span", class_="JWEO-stops-text")
-    times = soup("div", class_="vmXl vmXl-mod-variant-large")
-    day_after_flights = [
-        True if "+1" in str(t.find_all("span")[2].text) else False for t in times
-    ]
-    direct_flights = [
-        True if ("nonstop" in d_f.text) and (not d_a) else False
-        for d_f, d_a in zip(direct_flights, day_after_flights)
-    ]
-    return direct_flights
+    t = datetime.strptime(time_text, "%I:%M %p")
+    return datetime(2000, 1, 1, t.hour, t.minute, tzinfo=ZoneInfo(tz)).strftime(
+        "%H:%M%z"
+    )
 
 
-def get_flight_price(
-    soup: BeautifulSoup, direct_flights_mask: List[bool]
-) -> Tuple[List[float], List[str]]:
+def extract_flights(
+    html: str, tz_start: str, tz_end: str
+) -> Tuple[List[str], List[str], List[float], List[str]]:
     """
-    Get the prices and currencies of flights.
+    Extracts the direct flights from a Kayak result page in a single traversal of the DOM.
+    Flights that arrive the day after are excluded.
 
     Args:
-        soup (BeautifulSoup): The BeautifulSoup object representing the parsed HTML.
-        direct_flights_mask (List[bool]): A list of boolean values indicating whether each flight is a direct flight or not.
+        html (str): The HTML source of the page.
+        tz_start (str): The timezone of the source location.
+        tz_end (str): The timezone of the destination location.
 
     Returns:
-        Tuple[List[float], List[str]]: A tuple containing the prices and currencies of the flights.
+        Tuple[List[str], List[str], List[float], List[str]]: The start times, end times, prices and currencies of the flights.
     """
-    prices_str = soup.find_all("div", class_="f8F1-price-text")
+    times = []
+    stops = []
+    prices_str = []
+    for el in lxml.html.fromstring(html).iter("div", "span"):
+        cls = el.get("class")
+        if cls is None:
+            continue
+        if el.tag == "div":
+            if cls == TIMES_CLASS:
+                spans = el.findall(".//span")
+                times.append((spans[0].text_content(), spans[2].text_content()))
+            elif PRICE_CLASS in cls.split():
+                prices_str.append(el.text_content())
+        elif STOPS_CLASS in cls.split():
+            stops.append(el.text_content())
+
+    start_times = []
+    end_times = []
     prices = []
     currencies = []
-    for mask, p in zip(direct_flights_mask, prices_str):
-        if mask:
-            # remove comma that stands for thousands separator and dollar sign
-            price = float(p.text[1:].replace(",", ""))
-            prices.append(price)
-            currency = str(p.text[0])
-            currencies.append(currency)
-    return prices, currencies
+    # Elements are matched by position, as they appear once per result
+    for stop, (start, end), price in zip(stops, times, prices_str):
+        if "nonstop" not in stop or "+1" in end:
+            continue
+        start_times.append(to_local_time(start, tz_start))
+        end_times.append(to_local_time(end, tz_end))
+        # remove comma that stands for thousands separator and dollar sign
+        prices.append(float(price[1:].replace(",", "")))
+        currencies.append(price[0])
 
+    return start_times, end_times, prices, currencies
 
+
+_timezone_finder: Optional[TimezoneFinder] = None
+
+
+@functools.lru_cache(maxsize=None)
 def get_timezone(place_name: str):
     """
     Retrieves the timezone of a given location using its name.
+    Results are cached, and the polygon data of TimezoneFinder is loaded only once.
 
     Args:
         place_name (str): The name of the location.
@@ -128,18 +115,44 @@ def get_timezone(place_name: str):
     Raises:
         ValueError: If the location is not found.
     """
-    geopy.geocoders.options.default_timeout = 120000
-    geolocator = Nominatim(user_agent="tz_finder")
+    global _timezone_finder
+    geolocator = Nominatim(user_agent="tz_finder", timeout=120)
     location = geolocator.geocode(place_name)
 
     if location:
-        finder = TimezoneFinder()
-        zone = finder.timezone_at(lng=location.longitude, lat=location.latitude)
+        if _timezone_finder is None:
+            _timezone_finder = TimezoneFinder()
+        zone = _timezone_finder.timezone_at(lng=location.longitude, lat=location.latitude)
         return zone
     else:
         raise ValueError(f"Location {place_name} not found.")
 
 
+class TimezoneResolver:
+    """
+    Resolves airport codes to IANA timezones.
+
+    Codes are looked up in the precomputed table first; unknown codes fall back
+    to geocoding the place name from `iata_codes_mapping`, once per process.
+
+    Args:
+        iata_codes_mapping (Dict[str, str]): A dictionary mapping airport codes to place names.
+        timezones (Dict[str, str]): A dictionary mapping airport codes to precomputed timezones.
+    """
+
+    def __init__(self, iata_codes_mapping: Dict[str, str], timezones: Dict[str, str]):
+        self.iata_codes_mapping = iata_codes_mapping
+        self.timezones = dict(timezones)
+
+    def get(self, code: str) -> str:
+        zone = self.timezones.get(code)
+        if zone is None:
+            zone = get_timezone(self.iata_codes_mapping[code])
+            self.timezones[code] = zone
+            log.warning(f"Timezone of {code} not precomputed, resolved to {zone}")
+        return zone
+
+
 def generate_date_range(start_date_str: str, end_date_str: str) -> List[str]:
     """
     Generates a list of dates within a given date range.
@@ -163,150 +176,644 @@ def generate_date_range(start_date_str: str, end_date_str: str) -> List[str]:
 
 def generate_permutations(
     dates: List[str], locations: List[str]
-) -> List[Tuple[str, str, str]]:
+) -> Iterator[Tuple[str, str, str]]:
     """
-    Generates all possible permutations of dates and locations.
+    Lazily generates all possible permutations of dates and locations.
 
     Args:
         dates (List[str]): A list of dates.
         locations (List[str]): A list of locations.
 
     Returns:
-        List[Tuple[str, str, str]]: A list of tuples representing the permutations of dates and locations.
+        Iterator[Tuple[str, str, str]]: An iterator of tuples representing the permutations of dates and locations.
     """
     location_permutations = list(itertools.permutations(locations, 2))
-    permutations = [
+    return (
         (date, loc1, loc2) for date in dates for loc1, loc2 in location_permutations
+    )
+
+
+def result_rows(result: List[Any]) -> Iterator[List[Any]]:
+    """
+    Generates the CSV rows of the flights of a scrape task.
+
+    Args:
+        result (List[Any]): The result of `scrape`: date, source, destination, start times, end times, prices and currencies.
+
+    Returns:
+        Iterator[List[Any]]: One row per flight.
+    """
+    date, source, destination, start_times, end_times, prices, currencies = result
+    for flight_data in zip(start_times, end_times, prices, currencies):
+        yield [date, source, destination] + list(flight_data)
+
+
+def encode_results(results: Iterable[List[Any]]) -> bytes:
+    """
+    Encodes the flights of several scrape tasks as a CSV file, header included.
+
+    Args:
+        results (Iterable[List[Any]]): The results of `scrape`.
+
+    Returns:
+        bytes: The content of the CSV file.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow(ResultWriter.header)
+    for result in results:
+        writer.writerows(result_rows(result))
+    return buffer.getvalue().encode()
+
+
+def merge_partials(minio_client: Minio, bucket_name: str, prefix: str, file_path: str) -> int:
+    """
+    Merges the partial CSV files under a prefix of the bucket in a single local
+    file, then deletes the partial files.
+
+    A task delivered again after a worker crash may be uploaded in several
+    partial files: the partial files are read from the oldest, and the rows of
+    a (date, source, destination) key are only taken from the first one
+    holding that key, so the merged file does not depend on redeliveries.
+
+    Args:
+        minio_client (Minio): The MinIO client.
+        bucket_name (str): The name of the bucket holding the partial files.
+        prefix (str): The prefix of the partial files.
+        file_path (str): The path of the merged file.
+
+    Returns:
+        int: The number of merged partial files.
+    """
+    objects = sorted(
+        minio_client.list_objects(bucket_name, prefix=prefix, recursive=True),
+        key=lambda o: (o.last_modified, o.object_name),
+    )
+    merged = set()
+    with open(file_path, "x", newline="") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(ResultWriter.header)
+        for obj in objects:
+            response = minio_client.get_object(bucket_name, obj.object_name)
+            try:
+                reader = csv.reader(io.StringIO(response.read().decode()), delimiter=";")
+                next(reader, None)
+                rows = [row for row in reader if tuple(row[:3]) not in merged]
+            finally:
+                response.close()
+                response.release_conn()
+            writer.writerows(rows)
+            merged.update(tuple(row[:3]) for row in rows)
+
+    remove_objects(minio_client, bucket_name, [obj.object_name for obj in objects])
+    return len(objects)
+
+
+def sweep_partials(minio_client: Minio, bucket_name: str, keep_prefix: str) -> int:
+    """
+    Deletes the partial files of the previous runs: the files uploaded for a
+    task delivered again after its run was merged, and those of crashed runs.
+    Only one coordinator runs at a time, so every other run is over.
+
+    Args:
+        minio_client (Minio): The MinIO client.
+        bucket_name (str): The name of the bucket holding the partial files.
+        keep_prefix (str): The prefix of the partial files of the current run.
+
+    Returns:
+        int: The number of deleted partial files.
+    """
+    object_names = [
+        o.object_name
+        for o in minio_client.list_objects(bucket_name, prefix="partial/", recursive=True)
+        if not o.object_name.startswith(keep_prefix)
     ]
-    return permutations
+    remove_objects(minio_client, bucket_name, object_names)
+    return len(object_names)
 
 
-def save_info(
-    dest_dir: str,
-    results: List[List[Any]],
-) -> str:
+def remove_objects(minio_client: Minio, bucket_name: str, object_names: List[str]):
+    errors = minio_client.remove_objects(
+        bucket_name, [DeleteObject(name) for name in object_names]
+    )
+    for error in errors:
+        log.error(f"Error deleting partial file: {error}")
+
+
+class ScrapeIndex:
     """
-    Saves flight information to a CSV file.
+    Index of the scraped (date, source, destination) keys and of the time they were scraped.
+
+    The index is built from the CSV objects in the training bucket and kept in a
+    JSON file, together with the names of the objects already indexed, so that
+    only new objects are downloaded when it is updated.
+
+    Args:
+        path (str): The path of the JSON file of the index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.objects: Set[str] = set()
+        self.scraped_at: Dict[str, float] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                index = json.load(f)
+            self.objects = set(index["objects"])
+            self.scraped_at = index["scraped_at"]
+
+    @staticmethod
+    def _key(date: str, source: str, destination: str) -> str:
+        return f"{date};{source};{destination}"
+
+    def add(self, date: str, source: str, destination: str, scraped_at: float):
+        key = self._key(date, source, destination)
+        self.scraped_at[key] = max(scraped_at, self.scraped_at.get(key, 0.0))
+
+    def is_stale(self, date: str, source: str, destination: str, max_age: float, now: float) -> bool:
+        """
+        Checks whether a key was never scraped or was scraped more than `max_age` seconds before `now`.
+        """
+        return now - self.scraped_at.get(self._key(date, source, destination), 0.0) > max_age
+
+    def update_from_bucket(self, minio_client: Minio, bucket_name: str):
+        """
+        Adds the keys of the CSV objects of the bucket that are not indexed yet.
+        The scrape time of an object is its creation-date metadata, or its last modification time.
+
+        Args:
+            minio_client (Minio): The MinIO client.
+            bucket_name (str): The name of the bucket holding the scraped data.
+        """
+        new_objects = [
+            o
+            for o in minio_client.list_objects(bucket_name, include_user_meta=True)
+            if o.object_name.endswith(".csv") and o.object_name not in self.objects
+        ]
+        for o in new_objects:
+            creation_date = (o.metadata or {}).get("X-Amz-Meta-Creation-Date")
+            if creation_date is not None:
+                scraped_at = time.mktime(time.strptime(creation_date, "%a %b %d %H:%M:%S %Y"))
+            else:
+                scraped_at = o.last_modified.timestamp()
+
+            response = minio_client.get_object(bucket_name, o.object_name)
+            try:
+                reader = csv.reader(io.TextIOWrapper(response, encoding="utf-8"), delimiter=";")
+                next(reader, None)
+                for row in reader:
+                    self.add(row[0], row[1], row[2], scraped_at)
+            finally:
+                response.close()
+                response.release_conn()
+            self.objects.add(o.object_name)
+        log.info(f"Indexed {len(new_objects)} new objects, {len(self.scraped_at)} keys in total")
+
+    def save(self):
+        # Write to a temporary file first, so a crash never leaves a corrupted index
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"objects": sorted(self.objects), "scraped_at": self.scraped_at}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class ResultWriter:
+    """
+    Appends the scraped flights to a CSV file as soon as each task completes.
+
+    Rows are buffered and flushed to disk every `flush_every` tasks. After each
+    flush the keys of the flushed tasks are appended to a journal, followed by
+    the size of the data file at that point. When a run is restarted, the data
+    file is truncated to the last size recorded in the journal and the journaled
+    (date, source, destination) keys can be skipped, so a crash loses at most one
+    batch. Use `finalize` once the run is over to get the final file, or
+    `discard` when no row was written.
 
     Args:
         dest_dir (str): The destination directory where the file will be saved.
-        results (List[List[Any]]): A list of flight information.
+        flush_every (int, optional): The number of tasks written between two flushes. Defaults to 10.
+        resume (bool, optional): Whether to continue a previous interrupted run. Defaults to True.
+    """
+
+    header = ["date", "source", "destination", "start_time", "end_time", "price", "currency"]
+
+    def __init__(self, dest_dir: str, flush_every: int = 10, resume: bool = True):
+        self.dest_dir = dest_dir
+        self.data_path = dest_dir + "in_progress.csv"
+        self.journal_path = dest_dir + "in_progress.journal"
+        self.flush_every = flush_every
+        self.completed: Set[Tuple[str, str, str]] = set()
+        self.n_rows = 0
+        self._pending: List[Tuple[str, str, str]] = []
+        if resume:
+            self._load_journal()
+        else:
+            for path in (self.data_path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _load_journal(self):
+        if not os.path.exists(self.journal_path):
+            return
+        if not os.path.exists(self.data_path):
+            log.warning(f"Ignoring {self.journal_path}, data file not found")
+            os.remove(self.journal_path)
+            return
+        size = 0
+        batch = []
+        with open(self.journal_path) as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # torn write of the last line
+                    break
+                if line.startswith("@"):
+                    self.completed.update(batch)
+                    size = int(line[1:])
+                    batch = []
+                else:
+                    batch.append(tuple(line.rstrip("\n").split(";")))
+        # Drop the rows of the tasks that were not journaled
+        with open(self.data_path, "r+") as f:
+            f.truncate(size)
+            self.n_rows = max(sum(1 for _ in f) - 1, 0)
+        log.info(f"Resuming run: {len(self.completed)} tasks already completed")
+
+    def __enter__(self) -> "ResultWriter":
+        self._data = open(self.data_path, "a", newline="")
+        self._journal = open(self.journal_path, "a")
+        self._writer = csv.writer(self._data, delimiter=";")
+        if self._data.tell() == 0:
+            self._writer.writerow(self.header)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+        self._data.close()
+        self._journal.close()
+
+    def write(self, result: List[Any]):
+        """
+        Writes the flights of a completed task.
+
+        Args:
+            result (List[Any]): The result of `scrape`: date, source, destination, start times, end times, prices and currencies.
+        """
+        self._writer.writerows(result_rows(result))
+        self.n_rows += len(result[3])
+        self._pending.append(tuple(result[:3]))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._journal.write(
+            "".join(";".join(key) + "\n" for key in self._pending)
+            + f"@{self._data.tell()}\n"
+        )
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.completed.update(self._pending)
+        self._pending = []
+
+    def finalize(self) -> str:
+        """
+        Gives the data file its final name and removes the journal.
+
+        Returns:
+            str: The filename of the saved CSV file.
+        """
+        filename = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".csv"
+        os.rename(self.data_path, self.dest_dir + filename)
+        os.remove(self.journal_path)
+        return filename
+
+    def discard(self):
+        """
+        Removes the data file and the journal of a run that wrote no row.
+        """
+        os.remove(self.data_path)
+        os.remove(self.journal_path)
+
+
+# Resource types never needed to extract the flight data
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "media", "font"})
+
+
+def is_first_party(url: str, first_party_hosts: Iterable[str]) -> bool:
+    """
+    Checks whether a url belongs to one of the given hosts or to their subdomains.
+
+    Args:
+        url (str): The url to check.
+        first_party_hosts (Iterable[str]): The allowed host names, e.g. "kayak.com".
 
     Returns:
-        str: The filename of the saved CSV file.
+        bool: True if the host of the url matches one of the hosts.
     """
-    filename = datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".csv"
-    with open(dest_dir + filename, "x", newline="") as f:
-        writer = csv.writer(f, delimiter=";")
-        writer.writerow(
-            [
-                "date",
-                "source",
-                "destination",
-                "start_time",
-                "end_time",
-                "price",
-                "currency",
-            ]
+    host = urlparse(url).hostname or ""
+    return any(host == h or host.endswith("." + h) for h in first_party_hosts)
+
+
+def is_heavy_resource(request: Request, first_party_hosts: Iterable[str]) -> bool:
+    """
+    Checks whether a request loads an image, media, font or third-party script.
+
+    Args:
+        request (Request): The intercepted request.
+        first_party_hosts (Iterable[str]): The hosts whose scripts are allowed.
+
+    Returns:
+        bool: True if the request can be aborted without affecting the flight data.
+    """
+    return request.resource_type in BLOCKED_RESOURCE_TYPES or (
+        request.resource_type == "script"
+        and not is_first_party(request.url, first_party_hosts)
+    )
+
+
+class PagePool:
+    """
+    Pool of reusable browser contexts, each task gets a new page of an idle context.
+
+    Contexts are created once with the request interception installed, so
+    every scrape task only pays for a page and the navigation. The page is
+    closed after the task: a page navigated again keeps the JS heap of its
+    previous documents alive, a new page starts empty. The context of a failed
+    task, which may have crashed with its renderer, is replaced with a new one.
+
+    Args:
+        browser (Browser): The browser instance used for scraping.
+        size (int): The number of contexts, usually the number of concurrent tasks.
+        first_party_hosts (List[str]): The hosts whose scripts are allowed, if block_resources is True.
+        block_resources (bool, optional): Whether to abort heavy resources. Defaults to True.
+        locale (str, optional): The locale to use for the browser. Defaults to "en-US".
+    """
+
+    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
+
+    def __init__(
+        self,
+        browser: Browser,
+        size: int,
+        first_party_hosts: List[str],
+        block_resources: bool = True,
+        locale: str = "en-US",
+    ):
+        self.browser = browser
+        self.size = size
+        self.first_party_hosts = list(first_party_hosts)
+        self.block_resources = block_resources
+        self.locale = locale
+        self._contexts: List[BrowserContext] = []
+        self._idle: asyncio.Queue[BrowserContext] = asyncio.Queue()
+
+    async def __aenter__(self) -> "PagePool":
+        for _ in range(self.size):
+            context = await self._new_context()
+            self._contexts.append(context)
+            self._idle.put_nowait(context)
+        return self
+
+    async def _new_context(self) -> BrowserContext:
+        context = await self.browser.new_context(
+            user_agent=self.user_agent,
+            viewport={"width": 1920, "height": 1080},
+            screen={"width": 1920, "height": 1080},
+            locale=self.locale,
         )
-        for (
-            date,
-            source,
-            destination,
-            start_times,
-            end_times,
-            prices,
-            currencies,
-        ) in results:
-            for flight_data in zip(start_times, end_times, prices, currencies):
-                row = [
-                    date,
-                    source,
-                    destination,
-                ] + list(flight_data)
-                writer.writerow(row)
-    return filename
+        if self.block_resources:
+            await context.route("**/*", self._block_heavy_resources)
+        return context
+
+    async def _replace_context(self, context: BrowserContext) -> BrowserContext:
+        with contextlib.suppress(Exception):
+            await context.close()
+        try:
+            new_context = await self._new_context()
+        except Exception:
+            # The closed context fails the next task, which tries again
+            log.exception("Error creating a browser context")
+            return context
+        self._contexts[self._contexts.index(context)] = new_context
+        return new_context
+
+    async def __aexit__(self, *exc_info):
+        for context in self._contexts:
+            await context.close()
+        self._contexts = []
+
+    async def _block_heavy_resources(self, route: Route):
+        if is_heavy_resource(route.request, self.first_party_hosts):
+            await route.abort()
+        else:
+            await route.continue_()
+
+    @contextlib.asynccontextmanager
+    async def page(self) -> AsyncIterator[Page]:
+        context = await self._idle.get()
+        try:
+            page = await context.new_page()
+            try:
+                yield page
+            finally:
+                await page.close()
+        except Exception:
+            context = await self._replace_context(context)
+            raise
+        finally:
+            self._idle.put_nowait(context)
 
 
 async def scrape(
     task_id: int,
-    browser: Browser,
+    page: Page,
     date: str,
     source: str,
     destination: str,
-    iata_codes_mapping: Dict[str, str],
-    locale: str = "en-US",
+    timezones: TimezoneResolver,
+    rate_limiter: Optional["HostRateLimiter"] = None,
     prefix_url: str = "https://www.kayak.com/flights/",
     timeout: int = 120000,
+    show_more_timeout: int = 30000,
 ):
     """
     Scrapes flight data from Kayak website.
 
     Args:
         task_id (int): The ID of the task.
-        browser (Browser): The browser instance used for scraping.
+        page (Page): The browser page used for scraping, usually taken from a PagePool.
         date (str): The date of the flight.
         source (str): The source airport code.
         destination (str): The destination airport code.
-        iata_codes_mapping (Dict[str, str]): A dictionary mapping airport codes to timezones.
-        locale (str, optional): The locale to use for the browser. Defaults to "en-US".
+        timezones (TimezoneResolver): Resolver of the timezones of airport codes.
+        rate_limiter (HostRateLimiter, optional): Limiter applied before navigating to the url. Defaults to None.
         prefix_url (str, optional): The prefix URL for the flight search. Defaults to "https://www.kayak.com/flights/".
-        timeout (int, optional): The timeout for page navigation. Defaults to 60000 (60 seconds).
+        timeout (int, optional): The timeout for page navigation. Defaults to 120000 (120 seconds).
+        show_more_timeout (int, optional): The timeout for new results after clicking "show more". Defaults to 30000 (30 seconds).
 
     Returns:
         List: A list containing the scraped flight data, including date, source, destination, start times, end times, prices, and currencies.
+
+    Raises:
+        Exception: Any error raised while loading or parsing the page, so that the caller can retry.
     """
     # Generate the url, stops=~0 means approx direct flights only
     url = f"{prefix_url}{source}-{destination}/{date}?stops=~0&sort=bestflight_a"
 
-    # Initialize the browser context
-    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36"
-    context = await browser.new_context(
-        user_agent=user_agent,
-        viewport={"width": 1920, "height": 1080},
-        screen={"width": 1920, "height": 1080},
-        locale=locale,
-    )
-    page = await context.new_page()
+    # Start true scraping
+    if rate_limiter is not None:
+        await rate_limiter.wait(url)
+    await page.goto(url, timeout=timeout)
+    tz_start = timezones.get(source)
+    tz_end = timezones.get(destination)
 
+    # Accept cookies, the banner is shown only on the first visit of a context
     try:
-        # Start true scraping
-        await page.goto(url, timeout=timeout)
-        tz_start = get_timezone(iata_codes_mapping[source])
-        tz_end = get_timezone(iata_codes_mapping[destination])
+        await page.locator(
+            "xpath=//div[@class='RxNS-button-content' ]", has_text="Accept all"
+        ).click(timeout=5000)
+    except Exception as e:
+        log.info(f"TASK {task_id} - no cookies to accept")
 
-        # Accept cookies
-        try:
+    # Click "show more" button to get more flights, then wait for the new results
+    try:
+        for _ in range(2):
+            n_results = await page.locator(f"div.{PRICE_CLASS}").count()
             await page.locator(
-                "xpath=//div[@class='RxNS-button-content' ]", has_text="Accept all"
+                "xpath=//*[contains(@class, 'show-more-button')]"
             ).click()
-        except Exception as e:
-            log.info(f"TASK {task_id} - no cookies to accept")
+            await page.wait_for_function(
+                "([cls, n]) => document.getElementsByClassName(cls).length > n",
+                arg=[PRICE_CLASS, n_results],
+                timeout=show_more_timeout,
+            )
+    except Exception as e:
+        log.info(f"TASK {task_id} - no more flights to show")
+
+    start_times, end_times, prices, currencies = extract_flights(
+        await page.content(), tz_start, tz_end
+    )
+    log.info(
+        f"TASK {task_id} - source: {source} destination: {destination} date: {date}\n" +
+        f"prices: {len(prices)} start_times: {len(start_times)} end_times: {len(end_times)} currencies: {len(currencies)}")
+    return [date, source, destination, start_times, end_times, prices, currencies]
+
+
+async def scrape_with_retry(
+    max_retries: int,
+    backoff: float,
+    pool: PagePool,
+    **kwargs,
+) -> List[Any]:
+    """
+    Runs `scrape`, retrying failed attempts with exponential backoff.
+
+    Args:
+        max_retries (int): The number of retries after the first failed attempt.
+        backoff (float): The delay in seconds before the first retry, doubled at every further retry.
+        pool (PagePool): The pool providing the page of every attempt.
+        **kwargs: The arguments forwarded to `scrape`.
 
-        # Click "show more" button to get more flights
+    Returns:
+        List: The scraped flight data, or an empty list if every attempt failed.
+    """
+    task = f"TASK {kwargs['task_id']} ({kwargs['date']} {kwargs['source']}-{kwargs['destination']})"
+    for attempt in range(max_retries + 1):
         try:
-            for _ in range(2):
-                await page.locator(
-                    "xpath=//*[contains(@class, 'show-more-button')]"
-                ).click()
-                await asyncio.sleep(10)
-        except Exception as e:
-            log.info(f"TASK {task_id} - no more flights to show")
-
-        page_source = await page.content()
-        soup = BeautifulSoup(page_source, "html.parser")
-
-        direct_flights_mask = get_direct_flights_mask(soup)
-        start_times, end_times = get_flight_times(
-            soup, direct_flights_mask, tz_start, tz_end
-        )
-        prices, currencies = get_flight_price(soup, direct_flights_mask)
-        log.info(
-            f"TASK {task_id} - source: {source} destination: {destination} date: {date}\n" +
-            f"prices: {len(prices)} start_times: {len(start_times)} end_times: {len(end_times)} currencies: {len(currencies)}")
-        return [date, source, destination, start_times, end_times, prices, currencies]
-    except:
-        log.exception(f"Error scraping data from {url}")
-    finally:
-        await context.close()
+            async with pool.page() as page:
+                return await scrape(page=page, **kwargs)
+        except Exception:
+            if attempt == max_retries:
+                log.exception(f"{task} - giving up after {attempt + 1} attempts")
+                break
+            delay = backoff * 2**attempt
+            log.warning(f"{task} - attempt {attempt + 1} failed, retrying in {delay:.0f}s")
+            await asyncio.sleep(delay)
     return []
+
+
+class HostRateLimiter:
+    """
+    Enforces a minimum interval between requests sent to the same host.
+
+    Slots are reserved synchronously before sleeping, so concurrent tasks
+    on the same event loop never share a slot and no lock is needed.
+    """
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._next_slot: Dict[str, float] = {}
+
+    async def wait(self, url: str):
+        host = urlparse(url).netloc
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot.get(host, now))
+        self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def run_sliding_window(
+    tasks: Iterable[Tuple[str, str, str]] | AsyncIterable[Tuple[str, str, str]],
+    num_workers: int,
+    scrape_task: Callable[..., Awaitable[List[Any]]],
+    on_result: Callable[[List[Any]], None],
+    total: Optional[int] = None,
+    on_failure: Optional[Callable[[Tuple[str, str, str]], None]] = None,
+) -> int:
+    """
+    Keeps exactly `num_workers` scrape tasks in flight until `tasks` is exhausted.
+
+    Each worker pulls the next (date, source, destination) tuple as soon as its
+    previous task completes, so a slow page only delays its own worker. Tasks
+    can also come from an async iterable, e.g. a stream of queue deliveries.
+
+    Args:
+        tasks (Iterable[Tuple[str, str, str]] | AsyncIterable[Tuple[str, str, str]]): The (date, source, destination) tuples to scrape.
+        num_workers (int): The number of concurrent scrape tasks.
+        scrape_task (Callable): Coroutine function called with task_id, date, source and destination keywords.
+        on_result (Callable[[List[Any]], None]): Called with the result of every task that returned data.
+        total (int, optional): The number of tasks, used only for progress reporting. Defaults to None.
+        on_failure (Callable[[Tuple[str, str, str]], None], optional): Called with every task that returned no data. Defaults to None.
+
+    Returns:
+        int: The number of completed tasks.
+    """
+    task_ids = itertools.count()
+    completed = 0
+    start = time.monotonic()
+
+    if isinstance(tasks, AsyncIterable):
+        iterator = aiter(tasks)
+        # An async generator cannot be resumed while another worker awaits it
+        lock = asyncio.Lock()
+
+        async def next_task():
+            async with lock:
+                return await anext(iterator, None)
+    else:
+        # The shared iterator is safe: workers only interleave at await points
+        iterator = iter(tasks)
+
+        async def next_task():
+            return next(iterator, None)
+
+    async def worker():
+        nonlocal completed
+        while (task := await next_task()) is not None:
+            date, source, destination = task
+            result = await scrape_task(
+                task_id=next(task_ids), date=date, source=source, destination=destination
+            )
+            if result:
+                on_result(result)
+            elif on_failure is not None:
+                on_failure(task)
+            completed += 1
+            rate = completed / max(time.monotonic() - start, 1e-9) * 60
+            log.info(f"Progress: {completed}/{total or '?'} routes - {rate:.1f} routes/min")
+
+    await asyncio.gather(*[worker() for _ in range(num_workers)])
+    return completed
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# Parse-time benchmark of the flight extraction on a synthetic Kayak result page.
+# The results of the fixture are repeated to reach the size of a real page.
+# Usage: python tests/bench_extract.py [n_results] [n_runs]
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from utils_scrape import extract_flights  # noqa: E402
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__), "fixtures", "kayak_LHR-CDG_2024-09-01.html"
+)
+
+
+def main(n_results: int, n_runs: int):
+    with open(FIXTURE) as f:
+        html = f.read()
+    results = re.findall(r'    <div class="nrc6".*?\n    </div>\n', html, re.DOTALL)
+    page = html.replace(
+        "".join(results),
+        "".join(results[i % len(results)] for i in range(n_results)),
+    )
+
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        start_times, _, _, _ = extract_flights(page, "Europe/London", "Europe/Paris")
+    elapsed = (time.perf_counter() - start) / n_runs
+    print(
+        f"page: {len(page) / 2**10:.0f} KiB, {n_results} results, {len(start_times)} direct flights\n"
+        f"extract_flights: {elapsed * 1000:.2f} ms/page, {n_results / elapsed:.0f} results/sec"
+    )
+
+
+if __name__ == "__main__":
+    n_results = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    n_runs = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    main(n_results, n_runs)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Compare page-load time, JS heap, browser memory (PSS) and served bytes of a
+# fresh context per scrape (the old behaviour) against the reusable PagePool
+# with heavy resources blocked.
+# The synthetic Kayak page of tests/fixtures is served by a local server that all
+# hosts are mapped to, assets are served with an artificial latency.
+# CHROMIUM_EXECUTABLE runs another Chromium build than the one of Playwright.
+# Usage: python tests/bench_scrape_pages.py [n_pages] [n_workers]
+import asyncio
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from playwright.async_api import async_playwright
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from utils_scrape import PagePool  # noqa: E402
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__), "fixtures", "kayak_LHR-CDG_2024-09-01.html"
+)
+ASSET_LATENCY = 0.05
+# Served body and content type by file extension, anything else is a script
+ASSETS = {
+    ".png": (b"\0" * 200_000, "image/png"),
+    ".jpg": (b"\0" * 200_000, "image/jpeg"),
+    ".woff2": (b"\0" * 100_000, "font/woff2"),
+    ".mp4": (b"\0" * 1_000_000, "video/mp4"),
+}
+SCRIPT = (b"window._t = new Array(500000).fill(Math.random());", "text/javascript")
+FIRST_PARTY_HOSTS = ["kayak.com", "r9cdn.net"]
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    served_bytes = 0
+
+    def do_GET(self):
+        if self.path.startswith("/flights/"):
+            with open(FIXTURE, "rb") as f:
+                body, content_type = f.read().replace(b"https://", b"http://"), "text/html"
+        else:
+            time.sleep(ASSET_LATENCY)
+            extension = os.path.splitext(urlparse(self.path).path)[1]
+            body, content_type = ASSETS.get(extension, SCRIPT)
+        FixtureHandler.served_bytes += len(body)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+async def load(page, i):
+    start = time.perf_counter()
+    await page.goto(f"http://www.kayak.com/flights/LHR-CDG/2024-09-01?i={i}", wait_until="load")
+    elapsed = time.perf_counter() - start
+    # Garbage of the previous pages of a reused context is not counted
+    heap = await page.evaluate("gc(), performance.memory.usedJSHeapSize")
+    return elapsed, heap
+
+
+def browser_pss() -> int:
+    """The proportional set size in bytes of all the Chromium processes started by this process."""
+    children, parents = {}, {}
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        name, ppid = stat[stat.index("(") + 1:stat.rindex(")")], int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(pid))
+        parents[int(pid)] = name
+    pss, stack = 0, list(children.get(os.getpid(), []))
+    while stack:
+        pid = stack.pop()
+        stack += children.get(pid, [])
+        if "chrom" not in parents[pid]:
+            continue
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                pss += next(int(line.split()[1]) for line in f if line.startswith("Pss:")) * 1024
+        except (OSError, StopIteration):
+            pass
+    return pss
+
+
+async def sample_peak_pss(peak: list, interval: float = 0.05):
+    while True:
+        peak[0] = max(peak[0], browser_pss())
+        await asyncio.sleep(interval)
+
+
+async def fresh_contexts(browser, n_pages, n_workers):
+    semaphore = asyncio.Semaphore(n_workers)
+
+    async def task(i):
+        async with semaphore:
+            # The context options of scrape before the pool
+            context = await browser.new_context(
+                user_agent=PagePool.user_agent,
+                viewport={"width": 1920, "height": 1080},
+                screen={"width": 1920, "height": 1080},
+                locale="en-US",
+            )
+            try:
+                return await load(await context.new_page(), i)
+            finally:
+                await context.close()
+
+    return await asyncio.gather(*[task(i) for i in range(n_pages)])
+
+
+async def pooled_pages(browser, n_pages, n_workers):
+    async with PagePool(browser, n_workers, FIRST_PARTY_HOSTS) as pool:
+
+        async def task(i):
+            async with pool.page() as page:
+                return await load(page, i)
+
+        return await asyncio.gather(*[task(i) for i in range(n_pages)])
+
+
+async def main(n_pages: int, n_workers: int):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    async with async_playwright() as p:
+        # A browser per mode, so the peak memory of a mode does not include the other
+        for name, run in [("fresh context", fresh_contexts), ("page pool", pooled_pages)]:
+            browser = await p.chromium.launch(
+                executable_path=os.environ.get("CHROMIUM_EXECUTABLE"),
+                args=[
+                    f"--host-resolver-rules=MAP * 127.0.0.1:{port}",
+                    "--enable-precise-memory-info",
+                    "--js-flags=--expose-gc",
+                ],
+            )
+            FixtureHandler.served_bytes = 0
+            peak = [0]
+            sampler = asyncio.create_task(sample_peak_pss(peak))
+            start = time.perf_counter()
+            results = await run(browser, n_pages, n_workers)
+            total = time.perf_counter() - start
+            sampler.cancel()
+            load_times, heaps = zip(*results)
+            print(
+                f"{name:>14}: {total:6.2f}s total, "
+                f"{sum(load_times) / n_pages * 1000:7.1f} ms/page, "
+                f"{sum(heaps) / n_pages / 2**20:6.1f} MiB JS heap/page, "
+                f"{peak[0] / 2**20:6.0f} MiB peak browser PSS, "
+                f"{FixtureHandler.served_bytes / n_pages / 2**10:7.1f} KiB/page"
+            )
+            await browser.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    n_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    asyncio.run(main(n_pages, n_workers))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Startup benchmark of the predict server, serving a local model file.
+# Prints the import time of the direct imports of predict.py (python -X importtime)
+# and the time from process start to the first successful EstimatePrice RPC,
+# with the default config and with a hydra override.
+# Exits with status 1 if the default startup is slower than max_ms.
+# The generated gRPC code (priceest) must be importable, e.g. PYTHONPATH=<protoc output>.
+# Usage: python tests/bench_startup.py [model_file] [max_ms] [n_runs]
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import grpc
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src")
+sys.path.insert(0, SRC)
+from priceest import prices_pb2, prices_pb2_grpc  # noqa: E402
+
+MODEL_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "out", "model_2024-06-03_10-43-17.txt"
+)
+PORT = 50051
+
+
+def import_times(n_top: int = 10):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import predict"],
+        cwd=SRC, capture_output=True, text=True, check=True,
+    )
+    # Lines are "import time: <self us> | <cumulative us> | <indented module>",
+    # the imports of a module are listed before it, indented by 2 more spaces
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)", line)
+        if match is None:
+            continue
+        ms, indent, module = int(match.group(1)) / 1000, len(match.group(2)), match.group(3)
+        if indent == 0 and module == "predict":
+            total = ms
+            break
+        if indent == 0:
+            times = {}
+        elif indent == 2:
+            times[module] = ms
+    print(f"import predict: {total:.0f} ms")
+    for module, ms in sorted(times.items(), key=lambda x: -x[1])[:n_top]:
+        print(f"  {module}: {ms:.0f} ms")
+
+
+def time_to_first_rpc(model_file: str, args: list, timeout: float = 60) -> float:
+    request = prices_pb2.EstimatePriceRequest()
+    request.flight.source = "LHR"
+    request.flight.destination = "CDG"
+    request.flight.departure_time.FromSeconds(1725223500)
+    request.flight.arrival_time.FromSeconds(1725231900)
+
+    start = time.perf_counter()
+    # The server runs in a temporary directory, where hydra writes its log file
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(os.path.join(SRC, "predict.py")), *args],
+        cwd=tempfile.gettempdir(),
+        env={**os.environ, "PREDICT_MODEL_FILE": os.path.abspath(model_file)},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with grpc.insecure_channel(f"localhost:{PORT}") as channel:
+            stub = prices_pb2_grpc.PriceEstimationStub(channel)
+            while time.perf_counter() - start < timeout:
+                try:
+                    stub.EstimatePrice(request, timeout=1)
+                    return time.perf_counter() - start
+                except grpc.RpcError:
+                    if process.poll() is not None:
+                        raise Exception(f"Server exited with code {process.returncode}")
+                    time.sleep(0.005)
+        raise Exception(f"No successful RPC in {timeout}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(model_file: str, max_ms: float | None, n_runs: int):
+    import_times()
+    results = {}
+    for name, args in (("default", []), ("hydra", [f"server.port={PORT}"])):
+        runs = sorted(time_to_first_rpc(model_file, args) for _ in range(n_runs))
+        results[name] = runs[len(runs) // 2] * 1000
+        print(f"time to first RPC ({name}): {results[name]:.0f} ms (median of {n_runs})")
+
+    if max_ms is not None and results["default"] > max_ms:
+        print(f"Startup regression: {results['default']:.0f} ms > {max_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    model_file = sys.argv[1] if len(sys.argv) > 1 else MODEL_FILE
+    max_ms = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    n_runs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    main(model_file, max_ms, n_runs)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Golden-file tests of the flight extraction on synthetic Kayak result pages.
+# Every tests/fixtures/<page>.html is checked against <page>.golden.json.
+# Usage: python -m pytest tests/test_extract.py
+import glob
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from utils_scrape import extract_flights  # noqa: E402
+
+FIXTURES = sorted(
+    glob.glob(os.path.join(os.path.dirname(__file__), "fixtures", "kayak_*.html"))
+)
+
+
+@pytest.mark.parametrize("page", FIXTURES, ids=os.path.basename)
+def test_extract_flights(page):
+    with open(page) as f:
+        html = f.read()
+    with open(page.removesuffix(".html") + ".golden.json") as f:
+        golden = json.load(f)
+
+    start_times, end_times, prices, currencies = extract_flights(
+        html, golden["tz_start"], golden["tz_end"]
+    )
+
+    assert start_times == golden["start_times"]
+    assert end_times == golden["end_times"]
+    assert prices == golden["prices"]
+    assert currencies == golden["currencies"]
+
+
+def test_extract_flights_empty_page():
+    assert extract_flights("<html><body></body></html>", "UTC", "UTC") == ([], [], [], [])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# Checks that the featurization of the predict server gives the same predictions
+# as the pandas featurization used for training, on a scraped dataset.
+# Usage: python -m pytest tests/test_features.py
+import gc
+import os
+import sys
+import weakref
+from datetime import datetime, timezone
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from features import encode_flight, flight_features  # noqa: E402
+from utils_predict import build_flight_df  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+MODEL_FILE = os.path.join(ROOT, "out", "model_2024-06-03_10-43-17.txt")
+DATA_FILE = os.path.join(ROOT, "data", "scraped", "2024-06-03_10-43-15.csv")
+
+
+def to_utc(day: str, hour: str) -> datetime:
+    time = datetime.strptime(hour, "%H:%M%z").astimezone(timezone.utc).time()
+    return datetime.combine(datetime.strptime(day, "%Y-%m-%d").date(), time)
+
+
+def test_flight_features_match_build_flight_df():
+    model = lgb.Booster(model_file=MODEL_FILE)
+    data = pd.read_csv(DATA_FILE, sep=";", dtype=str)
+    columns = ["date", "source", "destination", "start_time", "end_time"]
+    expected = model.predict(build_flight_df(data[columns].copy())[model.feature_name()])
+
+    rows = [
+        encode_flight(
+            model,
+            flight_features(
+                flight.source,
+                flight.destination,
+                to_utc(flight.date, flight.start_time),
+                to_utc(flight.date, flight.end_time),
+            ),
+        )
+        for flight in data.itertuples()
+    ]
+    np.testing.assert_allclose(model.predict(rows), expected)
+
+
+def test_unknown_category_is_missing():
+    model = lgb.Booster(model_file=MODEL_FILE)
+    features = flight_features(
+        "XXX", "CDG", datetime(2024, 9, 1, 20, 45), datetime(2024, 9, 1, 22, 5)
+    )
+    row = encode_flight(model, features)
+    assert np.isnan(row[model.feature_name().index("source")])
+
+
+def test_replaced_model_is_not_kept_alive():
+    model = lgb.Booster(model_file=MODEL_FILE)
+    features = flight_features(
+        "LHR", "CDG", datetime(2024, 9, 1, 20, 45), datetime(2024, 9, 1, 22, 5)
+    )
+    encode_flight(model, features)
+    ref = weakref.ref(model)
+    del model
+    gc.collect()
+    assert ref() is None
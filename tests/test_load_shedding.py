@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Checks the additive increase and multiplicative decrease of the concurrency
+# limit, and the rejection of late or excess requests.
+# Usage: python -m pytest tests/test_load_shedding.py
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from load_shedding import (AdaptiveConcurrencyLimiter,  # noqa: E402
+                           QueueTimingExecutor, current_queue_delay)
+
+
+def test_late_request_is_rejected_and_cuts_the_limit():
+    limiter = AdaptiveConcurrencyLimiter(target_delay=0.1, min_limit=2, max_limit=10, backoff=0.5)
+    assert not limiter.try_acquire(queue_delay=0.2)
+    assert limiter.limit == 5
+    assert limiter.in_flight == 0
+
+
+def test_limit_does_not_fall_below_min_limit():
+    limiter = AdaptiveConcurrencyLimiter(target_delay=0.1, min_limit=2, max_limit=10, backoff=0.5)
+    for _ in range(10):
+        limiter.try_acquire(queue_delay=1.0)
+    assert limiter.limit == 2
+
+
+def test_requests_above_the_limit_are_rejected_until_released():
+    limiter = AdaptiveConcurrencyLimiter(target_delay=0.1, min_limit=1, max_limit=3)
+    assert all(limiter.try_acquire(queue_delay=0.0) for _ in range(3))
+    assert not limiter.try_acquire(queue_delay=0.0)
+    assert limiter.in_flight == 3
+
+    limiter.release()
+    assert limiter.try_acquire(queue_delay=0.0)
+
+
+def test_limit_grows_by_one_per_limit_requests_up_to_max_limit():
+    limiter = AdaptiveConcurrencyLimiter(target_delay=0.1, min_limit=1, max_limit=8, backoff=0.5)
+    limiter.try_acquire(queue_delay=1.0)
+    assert limiter.limit == 4
+    for _ in range(4):
+        assert limiter.try_acquire(queue_delay=0.0)
+        limiter.release()
+    assert limiter.limit == pytest.approx(5, abs=0.1)
+    for _ in range(100):
+        limiter.try_acquire(queue_delay=0.0)
+        limiter.release()
+    assert limiter.limit == 8
+
+
+def test_queue_timing_executor_exposes_the_queue_delay():
+    with QueueTimingExecutor(max_workers=1) as executor:
+        assert 0.0 <= executor.submit(current_queue_delay).result() < 1.0
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# Checks that merging the partial files of a run keeps the rows of a task
+# delivered twice only once, and that partial files of previous runs are swept.
+# Usage: python -m pytest tests/test_merge_partials.py
+import csv
+import io
+import os
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from utils_scrape import (encode_results, merge_partials,  # noqa: E402
+                          sweep_partials)
+
+FIRST = ["2024-09-01", "LHR", "CDG", ["08:00"], ["10:15"], [120.0], ["EUR"]]
+SECOND = [
+    "2024-09-02", "LHR", "CDG", ["09:00", "18:00"], ["11:15", "20:15"], [99.0, 150.0], ["EUR"] * 2
+]
+
+
+class Response(io.BytesIO):
+    def release_conn(self):
+        pass
+
+
+class Bucket:
+    """In-memory stand-in of the MinIO client, holding a single bucket."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put(self, object_name, data, minutes):
+        self.objects[object_name] = (data, datetime(2024, 9, 1) + timedelta(minutes=minutes))
+
+    def list_objects(self, bucket_name, prefix, recursive):
+        return [
+            SimpleNamespace(object_name=name, last_modified=modified)
+            for name, (_, modified) in self.objects.items()
+            if name.startswith(prefix)
+        ]
+
+    def get_object(self, bucket_name, object_name):
+        return Response(self.objects[object_name][0])
+
+    def remove_objects(self, bucket_name, delete_objects):
+        for obj in delete_objects:
+            del self.objects[obj.name]
+        return []
+
+
+def test_merge_partials_keeps_the_first_delivery(tmp_path):
+    bucket = Bucket()
+    # worker-a crashed after uploading, the tasks were delivered again to worker-b
+    bucket.put("partial/run/worker-b-0.csv.part", encode_results([FIRST, SECOND]), minutes=5)
+    bucket.put("partial/run/worker-a-3.csv.part", encode_results([FIRST]), minutes=1)
+
+    file_path = tmp_path / "run.csv"
+    assert merge_partials(bucket, "training", "partial/run/", str(file_path)) == 2
+    with open(file_path, newline="") as f:
+        rows = list(csv.reader(f, delimiter=";"))
+    assert [row[:4] for row in rows[1:]] == [
+        ["2024-09-01", "LHR", "CDG", "08:00"],
+        ["2024-09-02", "LHR", "CDG", "09:00"],
+        ["2024-09-02", "LHR", "CDG", "18:00"],
+    ]
+    assert bucket.objects == {}
+
+
+def test_sweep_partials_keeps_the_current_run():
+    bucket = Bucket()
+    bucket.put("partial/old/worker-a-0.csv.part", encode_results([FIRST]), minutes=1)
+    bucket.put("partial/new/worker-a-0.csv.part", encode_results([FIRST]), minutes=2)
+    assert sweep_partials(bucket, "training", "partial/new/") == 1
+    assert list(bucket.objects) == ["partial/new/worker-a-0.csv.part"]
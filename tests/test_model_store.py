@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Checks that the reloads of the model store are coalesced, that models already
+# loaded or older than the loaded ones are skipped, and that a model deleted
+# after its event does not prevent the reload of the others.
+# Usage: python -m pytest tests/test_model_store.py
+import io
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import lightgbm as lgb
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from model_store import ModelStore  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def model_str():
+    X = np.arange(40.0).reshape(20, 2)
+    return lgb.train({"verbose": -1}, lgb.Dataset(X, X[:, 0]), num_boost_round=2).model_to_string()
+
+
+class Response(io.BytesIO):
+    def __init__(self, data, headers):
+        super().__init__(data)
+        self.headers = headers
+
+    def read(self, decode_content=False):
+        return super().read()
+
+    def release_conn(self):
+        pass
+
+
+class Bucket:
+    """In-memory stand-in of the MinIO client, holding a single bucket of models."""
+
+    def __init__(self, model_str):
+        self.model_str = model_str
+        self.objects = {}
+        self.downloads = []
+
+    def put(self, object_name, etag, hours):
+        self.objects[object_name] = (etag, time.ctime(1_700_000_000 + hours * 3600))
+
+    def stat_object(self, bucket_name, object_name):
+        etag, created = self.objects[object_name]
+        return SimpleNamespace(
+            object_name=object_name, etag=etag, metadata={"x-amz-meta-creation-date": created}
+        )
+
+    def list_objects(self, bucket_name, include_user_meta):
+        return [
+            SimpleNamespace(
+                object_name=name, etag=etag, metadata={"X-Amz-Meta-Creation-Date": created}
+            )
+            for name, (etag, created) in self.objects.items()
+        ]
+
+    def get_object(self, bucket_name, object_name):
+        self.downloads.append(object_name)
+        etag, created = self.objects[object_name]
+        return Response(
+            self.model_str.encode(),
+            {"etag": f'"{etag}"', "x-amz-meta-creation-date": created},
+        )
+
+
+def test_reload_requests_are_coalesced_into_the_newest(model_str):
+    bucket = Bucket(model_str)
+    bucket.put("model_1.txt", "e1", hours=1)
+    bucket.put("model_2.txt", "e2", hours=2)
+    store = ModelStore(bucket, "models", reload_debounce=0.05)
+    store.request_reload("model_2.txt")
+    store.request_reload("model_1.txt")
+    time.sleep(0.3)
+    assert bucket.downloads == ["model_2.txt"]
+    assert store.model_name == "model_2.txt"
+    assert store.model_etag == "e2"
+
+
+def test_reload_skips_loaded_and_older_models(model_str):
+    bucket = Bucket(model_str)
+    bucket.put("model_1.txt", "e1", hours=1)
+    bucket.put("model_2.txt", "e2", hours=2)
+    bucket.put("model_2_copy.txt", "e2", hours=3)
+    store = ModelStore(bucket, "models")
+    store.load_model("model_2.txt")
+
+    store._reload_newest({"model_1.txt"})
+    store._reload_newest({"model_2_copy.txt"})
+    assert bucket.downloads == ["model_2.txt"]
+    assert store.model_name == "model_2.txt"
+
+
+def test_reload_ignores_models_deleted_after_their_event(model_str):
+    bucket = Bucket(model_str)
+    bucket.put("model_1.txt", "e1", hours=1)
+    store = ModelStore(bucket, "models")
+    store._reload_newest({"deleted.txt", "model_1.txt"})
+    assert store.model_name == "model_1.txt"
+
+
+def test_load_latest_model_does_not_replace_a_newer_model(model_str):
+    bucket = Bucket(model_str)
+    bucket.put("model_1.txt", "e1", hours=1)
+    bucket.put("model_2.txt", "e2", hours=2)
+    store = ModelStore(bucket, "models")
+    store.load_latest_model()
+    assert store.model_name == "model_2.txt"
+
+    # A newer model loaded by an event before the initial load lists the bucket
+    del bucket.objects["model_2.txt"]
+    store.load_latest_model()
+    assert bucket.downloads == ["model_2.txt"]
+    assert store.model_name == "model_2.txt"
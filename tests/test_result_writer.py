@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# Checks that a run resumed after a crash skips the journaled tasks only, and
+# that the rows of the tasks written after the last journal entry are dropped.
+# Usage: python -m pytest tests/test_result_writer.py
+import csv
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from utils_scrape import ResultWriter  # noqa: E402
+
+
+def result(date, n_flights):
+    return [
+        date, "LHR", "CDG",
+        [f"0{i}:00+0100" for i in range(n_flights)],
+        [f"0{i}:30+0200" for i in range(n_flights)],
+        [100.0 + i for i in range(n_flights)],
+        ["EUR"] * n_flights,
+    ]
+
+
+def read_rows(path):
+    with open(path, newline="") as f:
+        return list(csv.reader(f, delimiter=";"))
+
+
+def test_resume_after_crash_skips_journaled_tasks(tmp_path):
+    dest_dir = str(tmp_path) + "/"
+    writer = ResultWriter(dest_dir, flush_every=2).__enter__()
+    writer.write(result("2024-09-01", 2))
+    writer.write(result("2024-09-02", 0))
+    # Written but not journaled when the process dies, its rows reach the disk
+    writer.write(result("2024-09-03", 3))
+    writer._data.close()
+    # Torn journal entry of that task, its size must not be trusted
+    writer._journal.write("2024-09-03;LHR;CDG\n@40")
+    writer._journal.close()
+    assert len(read_rows(writer.data_path)) == 1 + 5
+
+    resumed = ResultWriter(dest_dir, flush_every=2)
+    assert resumed.completed == {("2024-09-01", "LHR", "CDG"), ("2024-09-02", "LHR", "CDG")}
+    assert resumed.n_rows == 2
+    rows = read_rows(resumed.data_path)
+    assert rows[0] == ResultWriter.header
+    assert [row[0] for row in rows[1:]] == ["2024-09-01"] * 2
+
+    with resumed:
+        resumed.write(result("2024-09-03", 3))
+    assert resumed.n_rows == 5
+    filename = resumed.finalize()
+    rows = read_rows(dest_dir + filename)
+    assert [row[0] for row in rows[1:]] == ["2024-09-01"] * 2 + ["2024-09-03"] * 3
+    assert os.listdir(dest_dir) == [filename]
+
+
+def test_no_resume_starts_over(tmp_path):
+    dest_dir = str(tmp_path) + "/"
+    with ResultWriter(dest_dir, flush_every=1) as writer:
+        writer.write(result("2024-09-01", 2))
+
+    restarted = ResultWriter(dest_dir, resume=False)
+    assert restarted.completed == set()
+    assert restarted.n_rows == 0
+    assert os.listdir(dest_dir) == []
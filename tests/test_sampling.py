@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Checks the streaming reduction of the training data on a scraped dataset.
+# Usage: python -m pytest tests/test_sampling.py
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from sampling import GROUP_COLUMNS, HashSet, reduce_training_data  # noqa: E402
+
+DATA_FILE = os.path.join(
+    os.path.dirname(__file__), "..", "data", "scraped", "2024-06-03_10-43-15.csv"
+)
+
+
+def test_hash_set_keeps_first_new_occurrence():
+    seen = HashSet()
+    first = seen.add_new(np.array([3, 1, 3, 2], dtype=np.uint64))
+    second = seen.add_new(np.array([2, 5, 5, 9], dtype=np.uint64))
+    assert first.tolist() == [True, True, False, True]
+    assert second.tolist() == [False, True, False, True]
+
+
+def test_reduce_training_data_without_cap_drops_duplicates_only():
+    distinct = pd.read_csv(DATA_FILE, sep=";", dtype=str).drop_duplicates()
+    df, weights, stats = reduce_training_data(DATA_FILE, max_rows_per_group=10**6, chunk_size=100)
+    pd.testing.assert_frame_equal(df, distinct)
+    assert (weights == 1).all()
+    assert stats["rows_out"] == len(distinct)
+
+
+def test_reduce_training_data_caps_groups_with_weights():
+    distinct = pd.read_csv(DATA_FILE, sep=";", dtype=str).drop_duplicates()
+    df, weights, stats = reduce_training_data(DATA_FILE, max_rows_per_group=5, chunk_size=100)
+
+    assert df.groupby(GROUP_COLUMNS).size().max() == 5
+    assert not df.duplicated().any()
+    assert df["date"].is_monotonic_increasing
+    # Every group weighs its distinct row count
+    group_weights = weights.groupby([df[c] for c in GROUP_COLUMNS]).sum()
+    group_sizes = distinct.groupby(GROUP_COLUMNS).size()
+    np.testing.assert_allclose(group_weights.reindex(group_sizes.index), group_sizes)
+    assert stats["reduction_ratio"] == round(len(df) / stats["rows_in"], 4)
+
+
+def test_reduce_training_data_hashes_do_not_depend_on_chunks():
+    # The missing price makes the first chunk a float column, the second an int one
+    data = io.StringIO(
+        "date;source;destination;price\n"
+        "2024-06-04;LHR;CDG;100\n"
+        "2024-06-04;LHR;CDG;\n"
+        "2024-06-04;LHR;CDG;100\n"
+        "2024-06-04;LHR;CDG;120\n"
+    )
+    df, weights, stats = reduce_training_data(data, max_rows_per_group=10, chunk_size=2)
+    assert stats["rows_distinct"] == 3
+    assert df["price"].fillna("").tolist() == ["100", "", "120"]
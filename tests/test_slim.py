@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Checks that slimming a saved model keeps its predictions, and that the
+# constant trees and the splits between equal leaves are removed.
+# Usage: python -m pytest tests/test_slim.py
+import os
+import sys
+
+import lightgbm as lgb
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+from slim import encode, format_model, parse_model, slim_model, slim_text  # noqa: E402
+from utils_predict import build_flight_df  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+MODEL_FILE = os.path.join(ROOT, "out", "model_2024-06-03_10-43-17.txt")
+DATA_FILE = os.path.join(ROOT, "data", "scraped", "2024-06-03_10-43-15.csv")
+
+
+@pytest.fixture(scope="module")
+def model():
+    return lgb.Booster(model_file=MODEL_FILE)
+
+
+@pytest.fixture(scope="module")
+def data(model):
+    df = build_flight_df(pd.read_csv(DATA_FILE, sep=";"))
+    return df[model.feature_name()], df["price"]
+
+
+def test_slim_text_keeps_predictions(model, data):
+    rows = encode(model, data[0])
+    text, _ = slim_text(model.model_to_string())
+    slim = lgb.Booster(model_str=text)
+    assert len(text) < len(model.model_to_string())
+    np.testing.assert_array_equal(slim.predict(rows), model.predict(rows))
+
+
+def test_slim_text_removes_constant_trees(model, data):
+    header, trees, tail = parse_model(model.model_to_string())
+    for tree in trees[5:8]:
+        tree["leaf_value"] = " ".join(["0.5"] * int(tree["num_leaves"]))
+    reference = lgb.Booster(model_str=format_model(header, trees, tail))
+
+    text, counts = slim_text(reference.model_to_string())
+    slim = lgb.Booster(model_str=text)
+    rows = encode(model, data[0])
+    assert counts["trees_dropped"] == 3
+    assert slim.num_trees() == reference.num_trees() - 3
+    np.testing.assert_allclose(slim.predict(rows), reference.predict(rows))
+
+
+def test_slim_model_refuses_rmse_change(model, data):
+    with pytest.raises(Exception, match="not publishing"):
+        slim_model(model, *data, rmse_tolerance=0.001, min_split_gain=1e12)
+
+
+def test_slim_text_keeps_sections_of_single_leaf_trees():
+    X = pd.DataFrame({"a": np.arange(20.0), "b": np.arange(20.0) % 3})
+    constant = lgb.train(
+        {"objective": "regression", "verbose": -1}, lgb.Dataset(X, np.full(20, 7.0)),
+        num_boost_round=3,
+    )
+    text, _ = slim_text(constant.model_to_string())
+    assert "feature_importances:\n\nparameters:\n" in text
+    assert text.count("end of parameters") == 1
+    slim = lgb.Booster(model_str=text)
+    np.testing.assert_allclose(slim.predict(X), constant.predict(X))
+
+
+def test_slim_text_keeps_constant_trees_of_random_forests():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({"a": rng.random(200), "b": rng.random(200)})
+    forest = lgb.train(
+        {"boosting": "rf", "bagging_fraction": 0.8, "bagging_freq": 1, "verbose": -1},
+        lgb.Dataset(X, X["a"].to_numpy() * 3 + rng.random(200)),
+        num_boost_round=5,
+    )
+    header, trees, tail = parse_model(forest.model_to_string())
+    trees[1]["leaf_value"] = " ".join(["0.5"] * int(trees[1]["num_leaves"]))
+    reference = lgb.Booster(model_str=format_model(header, trees, tail))
+
+    text, counts = slim_text(reference.model_to_string())
+    assert counts["trees_dropped"] == 0
+    np.testing.assert_allclose(lgb.Booster(model_str=text).predict(X), reference.predict(X))